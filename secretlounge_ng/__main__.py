@@ -3,15 +3,20 @@ import yaml
 import threading
 import sys
 import os
+import re
 import getopt
+import signal
+import importlib
+import importlib.util
 
-from . import core, telegram
+from . import core, telegram, admin, replication
 from .globals import *
-from .database import JSONDatabase, SQLiteDatabase
+from .database import JSONDatabase, MemoryDatabase, LogDatabase, SQLiteDatabase
 from .cache import Cache
-from .util import Scheduler
+from .util import Scheduler, metrics
 
 opts = {}
+config_path = None
 
 def start_new_thread(func, join=False, args=(), kwargs=None):
 	t = threading.Thread(target=func, args=args, kwargs=kwargs)
@@ -34,6 +39,7 @@ def usage():
 	print("  -q    Quiet, set log level to WARNING")
 	print("  -d    Debug, set log level to DEBUG")
 	print("  -c    Location of config file (default: ./config.yaml)")
+	print("        can be given multiple times to run several bots in one process")
 
 def load_config(path):
 	with open(path, "r") as f:
@@ -50,15 +56,150 @@ def open_db(config):
 	type_, args = config["database"][0].lower(), config["database"][1:]
 	if type_ == "json":
 		return JSONDatabase(*args)
+	elif type_ == "log":
+		return LogDatabase(*args)
+	elif type_ == "memory":
+		return MemoryDatabase(*args)
 	elif type_ == "sqlite":
 		path = os.path.split(args[0])
 		if path[0] != '':
 			os.makedirs(path[0], exist_ok=True)
-		return SQLiteDatabase(os.path.join(*path))
+		kwargs = {}
+		if "database_commit_interval" in config.keys():
+			kwargs["commit_interval"] = float(config["database_commit_interval"])
+		if "database_synchronous" in config.keys():
+			kwargs["synchronous"] = str(config["database_synchronous"])
+		if config.get("database_backup_dir"):
+			kwargs["backup_dir"] = config["database_backup_dir"]
+			kwargs["backup_interval"] = float(config.get("database_backup_interval", 60))
+			kwargs["backup_keep"] = int(config.get("database_backup_keep", 24))
+			kwargs["backup_compress"] = bool(config.get("database_backup_compress", False))
+		if config.get("database_retention_days"):
+			kwargs["retention_days"] = float(config["database_retention_days"])
+		return SQLiteDatabase(os.path.join(*path), **kwargs)
 	else:
 		logging.error("Unknown database type.")
 		exit(1)
 
+# re-reads the config file and applies the settings that can change at runtime,
+# either all of them or (if anything is invalid) none
+def reload_config():
+	try:
+		config = load_config(config_path)
+		t = (core.load_tunables(config), telegram.load_tunables(config))
+	except Exception as e:
+		logging.error("Not reloading config from %s: %s", config_path, e)
+		return False
+	core.set_tunables(t[0])
+	telegram.set_tunables(t[1])
+	logging.info("Reloaded config from %s", config_path)
+	return True
+
+# set up everything for a bot, the caller needs to run the scheduler and telegram.run
+def start(config, sched, name=None, path=None):
+	global config_path
+	config_path = path
+	# Create and initialize various classes
+	db = open_db(config)
+	ch = Cache()
+
+	core.init(config, db, ch)
+	telegram.init(config, db, ch)
+	admin.init(config, db, reload_config)
+
+	if config.get("replication_target"):
+		if not isinstance(db, SQLiteDatabase):
+			logging.error("Replication requires the sqlite database type")
+			exit(1)
+		replication.init(config, db)
+		replication.register_tasks(sched)
+	elif isinstance(db, SQLiteDatabase):
+		replication.remove_log(db.path)
+
+	# Set up scheduler
+	db.register_tasks(sched)
+	core.register_tasks(sched)
+	telegram.register_tasks(sched)
+	sched.register(lambda: metrics.log(name), name="metrics", minutes=10)
+
+	for i in range(len(telegram.message_queue.shards)):
+		start_new_thread(telegram.send_thread, args=(i, ))
+	start_new_thread(admin.run)
+	return db
+
+## running multiple bots in one process ##
+
+class PrefixedScheduler():
+	def __init__(self, sched, prefix):
+		self.sched = sched
+		self.prefix = prefix
+	def register(self, func, *, name=None, **kwargs):
+		name = name or getattr(func, "__qualname__", None) or repr(func)
+		self.sched.register(func, name=self.prefix + "." + name, **kwargs)
+
+# core and telegram keep their state at module level, so every bot gets
+# a private copy of this package
+def load_instance(name):
+	pkgname = __package__ + "_" + name
+	path = os.path.dirname(os.path.abspath(__file__))
+	spec = importlib.util.spec_from_file_location(pkgname,
+		os.path.join(path, "__init__.py"), submodule_search_locations=[path])
+	pkg = importlib.util.module_from_spec(spec)
+	sys.modules[pkgname] = pkg
+	spec.loader.exec_module(pkg)
+	return importlib.import_module(pkgname + ".__main__")
+
+def main_multi(configpaths):
+	import requests
+	import telebot
+
+	# all bots share one connection pool
+	session = requests.Session()
+	adapter = requests.adapters.HTTPAdapter(pool_maxsize=4 * len(configpaths))
+	session.mount("https://", adapter)
+	session.mount("http://", adapter)
+	telebot.apihelper.session = session
+
+	# the pool also grows with every background task the bots register,
+	# but make sure each bot gets at least one worker from the start
+	sched = Scheduler(workers=len(configpaths))
+	dbs = []
+	instances = []
+	names = set()
+	for configpath in configpaths:
+		config = load_config(configpath)
+		# relative paths are relative to the config file in this mode
+		base = os.path.dirname(configpath)
+		if len(config["database"]) > 1 and not os.path.isabs(config["database"][1]):
+			config["database"][1] = os.path.join(base, config["database"][1])
+		for key in ("admin_socket", "database_backup_dir", "replication_target"):
+			if config.get(key) and not os.path.isabs(config[key]):
+				config[key] = os.path.join(base, config[key])
+		name = re.sub(r'\W', '_', os.path.basename(os.path.abspath(base)) or "bot")
+		while name in names:
+			name += "_"
+		names.add(name)
+
+		logging.info("Starting bot %s (%s)", name, configpath)
+		m = load_instance(name)
+		dbs.append(m.start(config, PrefixedScheduler(sched, name), name, configpath))
+		start_new_thread(m.telegram.run)
+		instances.append(m)
+
+	if hasattr(signal, "SIGHUP"):
+		signal.signal(signal.SIGHUP, lambda *_: start_new_thread(
+			lambda: list(m.reload_config() for m in instances)))
+
+	sched.register(lambda: metrics.log("scheduler"), name="metrics", minutes=10)
+	try:
+		start_new_thread(sched.run, join=True)
+	except KeyboardInterrupt:
+		logging.info("Interrupted, exiting")
+		for m, db in zip(instances, dbs):
+			m.admin.close()
+			db.close()
+		os._exit(1)
+
 def main():
 	global opts
 	# Process command line args
@@ -76,35 +217,30 @@ def main():
 		loglevel = logging.WARNING
 	elif readopt("-d") is not None:
 		loglevel = logging.DEBUG
-	configpath = readopt("-c") or "./config.yaml"
-
-	# Begin actual startup
-	config = load_config(configpath)
+	configpaths = list(e[1] for e in opts if e[0] == "-c") or ["./config.yaml"]
 
 	logging.basicConfig(format="%(levelname)-7s [%(asctime)s] %(message)s", datefmt="%Y-%m-%d %H:%M:%S", level=loglevel)
 	logging.info("secretlounge-ng v%s starting up", VERSION)
 
-	# Create and initialize various classes
-	db = open_db(config)
-	ch = Cache()
+	if len(configpaths) > 1:
+		return main_multi(configpaths)
 
-	core.init(config, db, ch)
-	telegram.init(config, db, ch)
+	# Begin actual startup
+	config = load_config(configpaths[0])
 
-	# Set up scheduler
 	sched = Scheduler()
-	db.register_tasks(sched)
-	core.register_tasks(sched)
-	telegram.register_tasks(sched)
+	db = start(config, sched, path=configpaths[0])
+	if hasattr(signal, "SIGHUP"):
+		signal.signal(signal.SIGHUP, lambda *_: start_new_thread(reload_config))
 
 	# Start all threads
-	start_new_thread(telegram.send_thread)
 	start_new_thread(sched.run)
 
 	try:
 		start_new_thread(telegram.run, join=True)
 	except KeyboardInterrupt:
 		logging.info("Interrupted, exiting")
+		admin.close()
 		db.close()
 		os._exit(1)
 
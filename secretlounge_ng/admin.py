@@ -0,0 +1,97 @@
+import logging
+import os
+import json
+import socket
+
+from . import core
+from .globals import *
+
+# Local control socket for the utilities in util/, so their changes go
+# through the running bot instead of the database file.
+# Protocol: one JSON object per line in each direction, e.g.
+# -> {"cmd": "ban", "entries": [[12345, "reason"]]}
+# <- {"ok": true, "result": [1, 0]}
+
+# module variables
+
+db = None
+path: str = None
+reload_func = None
+
+USER_ATTRS = ("username", "realname", "rank", "joined", "left", "lastActive",
+	"cooldownUntil", "blacklistReason", "warnings", "warnExpiry", "karma")
+
+def init(config: dict, _db, _reload_func):
+	global db, path, reload_func
+	db = _db
+	reload_func = _reload_func
+	path = config.get("admin_socket")
+
+def run():
+	if not path:
+		return
+	if os.path.exists(path):
+		os.unlink(path) # left over from a previous run
+	sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	sock.bind(path)
+	os.chmod(path, 0o600)
+	sock.listen()
+	logging.info("Admin socket listening on %s", path)
+	# clients are served one at a time by this thread, they only
+	# send a single command per connection anyway
+	while True:
+		conn, _ = sock.accept()
+		conn.settimeout(60) # don't let a stuck client block the others
+		try:
+			handle(conn)
+		except OSError as e:
+			logging.warning("Admin socket connection failed: %s", e)
+
+# removes the socket so the utilities stop trying to use it
+def close():
+	if path and os.path.exists(path):
+		os.unlink(path)
+
+def handle(conn):
+	with conn, conn.makefile("rw", encoding="utf-8") as f:
+		for line in f:
+			try:
+				req = json.loads(line)
+				func = commands[req.pop("cmd")]
+				resp = {"ok": True, "result": func(**req)}
+			except Exception as e:
+				logging.exception("Exception raised in admin socket")
+				resp = {"ok": False, "error": "%s: %s" % (type(e).__name__, e)}
+			f.write(json.dumps(resp, default=str) + "\n")
+			f.flush()
+
+def _userToList(user):
+	return [user.id] + list(getattr(user, k) for k in USER_ATTRS)
+
+# commands
+
+def c_ban(entries):
+	return core.admin_ban_users(entries)
+
+def c_unban(ids):
+	return core.admin_unban_users(ids)
+
+def c_setrank(id, rank):
+	return core.admin_set_rank(int(id), int(rank))
+
+def c_find(term):
+	return list(_userToList(user) for user in db.findUsers(term))
+
+def c_list(rank=None):
+	return list(_userToList(user) for user in db.getPrivilegedUsers(rank))
+
+def c_stats():
+	return db.countUsers()
+
+def c_reload():
+	return reload_func()
+
+commands = {
+	"ban": c_ban, "unban": c_unban, "setrank": c_setrank, "find": c_find,
+	"list": c_list, "stats": c_stats, "reload": c_reload,
+}
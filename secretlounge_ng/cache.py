@@ -2,21 +2,23 @@ import logging
 import itertools
 from datetime import datetime, timedelta
 from threading import RLock
-from typing import Optional, Sequence, Set, Iterator, Dict
+from typing import Optional, Sequence, Set, Iterator, Dict, Iterable, List
 
 from .globals import *
 
 class CachedMessage():
-	__slots__ = ('user_id', 'time', 'warned', 'upvoted')
+	__slots__ = ('user_id', 'time', 'warned', 'upvoted', 'cleaned')
 	user_id: Optional[int]
 	time: datetime
 	warned: bool
 	upvoted: Set[int]
+	cleaned: bool
 	def __init__(self, user_id=None):
 		self.user_id = user_id # who has sent this message
 		self.time = datetime.now() # when was this message created?
 		self.warned = False # was the user warned for this message?
 		self.upvoted = set() # user ids that have given this message karma
+		self.cleaned = False # was this message already deleted by /cleanup?
 	def isExpired(self):
 		return datetime.now() >= self.time + timedelta(hours=MESSAGE_EXPIRE_HOURS)
 	def hasUpvoted(self, user):
@@ -29,16 +31,20 @@ class Cache():
 	counter: Iterator[int]
 	msgs: Dict[int, CachedMessage]
 	idmap: Dict[int, Dict[int, object]]
+	authors: Dict[int, Set[int]]
 	def __init__(self):
 		self.lock = RLock()
 		self.counter = itertools.count()
 		self.msgs = {} # dict(msid -> CachedMessage)
 		self.idmap = {} # dict(uid -> dict(msid -> opaque))
+		self.authors = {} # dict(uid -> set(msid)) of messages sent by that user
 
 	def assignMessageId(self, cm: CachedMessage) -> int:
 		with self.lock:
 			ret = next(self.counter)
 			self.msgs[ret] = cm
+			if cm.user_id is not None:
+				self.authors.setdefault(cm.user_id, set()).add(ret)
 		return ret
 	def getMessage(self, msid: int) -> CachedMessage:
 		with self.lock:
@@ -47,6 +53,22 @@ class Cache():
 		with self.lock:
 			for msid, cm in self.msgs.items():
 				functor(msid, cm)
+	# user ids that have messages in the cache
+	def getAuthors(self) -> List[int]:
+		with self.lock:
+			return list(self.authors.keys())
+	# marks the messages sent by any of `uids` as cleaned up,
+	# returns the msids that weren't already
+	def markCleaned(self, uids: Iterable[int]) -> List[int]:
+		ret = []
+		with self.lock:
+			for uid in uids:
+				for msid in self.authors.get(uid, ()):
+					cm = self.msgs[msid]
+					if not cm.cleaned:
+						cm.cleaned = True
+						ret.append(msid)
+		return ret
 
 	# get user-specific mapping by key
 	def getMapping(self, uid: int, msid: int) -> object:
@@ -81,7 +103,11 @@ class Cache():
 					continue
 				ids.add(msid)
 				# delete message itself and from mappings
-				del self.msgs[msid]
+				uid = self.msgs.pop(msid).user_id
+				if uid is not None:
+					self.authors[uid].discard(msid)
+					if len(self.authors[uid]) == 0:
+						del self.authors[uid]
 				self.deleteMappings(msid)
 		if len(ids) > 0:
 			logging.debug("Expired %d entries from cache", len(ids))
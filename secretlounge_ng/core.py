@@ -1,21 +1,23 @@
 import logging
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
 from threading import Lock
 from importlib import import_module
-from typing import Optional, Dict
+from typing import Optional
 
 from . import replies as rp
 from .globals import *
 from .database import User, SystemConfig
 from .cache import CachedMessage
-from .util import ScoreKeeper, genTripcode
+from .util import ScoreKeeper, ExpiringMap, metrics
 
 # module variables
 
 db = None
 ch = None
 spam_scores: ScoreKeeper = None
-sign_last_used: Dict[int, datetime] = {}
+sign_last_used = ExpiringMap() # user ids that recently signed a message
+oid_index = (None, {}) # (day ordinal, dict(obfuscated id -> set of user ids))
+oid_index_lock = Lock()
 
 # settings
 
@@ -33,20 +35,17 @@ class IUserContainer():
 		raise NotImplementedError()
 
 def init(config: dict, _db, _ch):
-	global db, ch, spam_scores, blacklist_contact, enable_signing, allow_remove_command, media_limit_period, sign_interval
+	global db, ch, spam_scores
 	db = _db
 	ch = _ch
 	spam_scores = ScoreKeeper(SPAM_LIMIT, SPAM_LIMIT_HIT)
+	metrics.gauge("core.spam_scores", lambda: len(spam_scores.scores))
+	metrics.gauge("core.sign_last_used", lambda: len(sign_last_used))
+	metrics.gauge("core.oid_index", lambda: len(oid_index[1]))
+	metrics.gauge("db.dirty_users", lambda: len(db.dirty))
+	db.lock.register_metrics("db.lock")
 
-	blacklist_contact = config.get("blacklist_contact", "")
-	enable_signing = config["enable_signing"]
-	allow_remove_command = config["allow_remove_command"]
-	if "media_limit_period" in config.keys():
-		media_limit_period = timedelta(hours=int(config["media_limit_period"]))
-	sign_interval = timedelta(seconds=int(config.get("sign_limit_interval", 600)))
-
-	if config.get("locale"):
-		rp.localization = import_module("..replies_" + config["locale"], __name__).localization
+	set_tunables(load_tunables(config))
 
 	if config.get("secret_salt"):
 		User.setSalt(bytes.fromhex(config["secret_salt"]))
@@ -57,40 +56,94 @@ def init(config: dict, _db, _ch):
 		c.defaults()
 		db.setSystemConfig(c)
 
+# settings that can be changed at runtime (see __main__.reload_config),
+# this validates everything and raises an exception on error
+def load_tunables(config: dict):
+	t = {}
+	t["blacklist_contact"] = config.get("blacklist_contact", "")
+	t["enable_signing"] = bool(config["enable_signing"])
+	t["allow_remove_command"] = bool(config["allow_remove_command"])
+	t["media_limit_period"] = None
+	if "media_limit_period" in config.keys():
+		t["media_limit_period"] = timedelta(hours=int(config["media_limit_period"]))
+	t["sign_interval"] = timedelta(seconds=int(config.get("sign_limit_interval", 600)))
+	t["localization"] = {}
+	if config.get("locale"):
+		t["localization"] = import_module("..replies_" + config["locale"], __name__).localization
+	t["spam"] = spam_tunables(config)
+	return t
+
+def set_tunables(t: dict):
+	global blacklist_contact, enable_signing, allow_remove_command, media_limit_period, sign_interval
+	blacklist_contact = t["blacklist_contact"]
+	enable_signing = t["enable_signing"]
+	allow_remove_command = t["allow_remove_command"]
+	media_limit_period = t["media_limit_period"]
+	sign_interval = t["sign_interval"]
+	rp.localization = t["localization"]
+	spam_scores.set_limits(t["spam"]["SPAM_LIMIT"], t["spam"]["SPAM_LIMIT_HIT"])
+
 def register_tasks(sched):
 	# spam score handling
-	sched.register(spam_scores.decrease, seconds=SPAM_INTERVAL_SECONDS)
+	sched.register(spam_scores.decrease, name="spam_decay", seconds=SPAM_INTERVAL_SECONDS)
+	# expire transient per-user state
+	sched.register(sign_last_used.expire, name="sign_expiry", minutes=1)
 	# warning removal
 	def task():
-		now = datetime.now()
-		for user in db.iterateUsers():
-			if not user.isJoined():
-				continue
-			if user.warnExpiry is not None and now >= user.warnExpiry:
-				with db.modifyUser(id=user.id) as user:
-					user.removeWarning()
-	sched.register(task, minutes=15)
+		n = db.removeExpiredWarnings(datetime.now())
+		if n > 0:
+			logging.debug("Removed expired warnings from %d users", n)
+	sched.register(task, name="warning_removal", background=True, minutes=15)
 
 def updateUserFromEvent(user, c_user: IUserContainer):
 	user.username = c_user.username
 	user.realname = c_user.realname
 	user.lastActive = datetime.now()
 
+# same as above, but the change is only written to the db lazily
+def touchUserFromEvent(user, c_user: IUserContainer):
+	updateUserFromEvent(user, c_user)
+	db.updateUserLazy(user.id, username=user.username, realname=user.realname,
+		lastActive=user.lastActive)
+
 def getUserByName(username):
-	username = username.lstrip("@").lower()
+	username = username.lstrip("@")
 	# there *should* only be a single joined user with a given username
-	for user in db.iterateUsers():
-		if not user.isJoined():
-			continue
-		if user.username is not None and user.username.lower() == username:
-			return user
-	return None
+	try:
+		return db.getUser(username=username)
+	except KeyError as e:
+		return None
+
+# obfuscated ids only change once a day, so keep an index for the current day
+def _getOidIndex():
+	global oid_index
+	day = date.today().toordinal()
+	with oid_index_lock:
+		if oid_index[0] != day:
+			d = {}
+			for user in db.iterateUsers():
+				if user.isJoined():
+					d.setdefault(user.getObfuscatedId(), set()).add(user.id)
+			oid_index = (day, d)
+			logging.debug("Built obfuscated id index (%d entries)", len(d))
+		return oid_index[1]
+
+def _addToOidIndex(user):
+	with oid_index_lock:
+		if oid_index[0] == date.today().toordinal():
+			oid_index[1].setdefault(user.getObfuscatedId(), set()).add(user.id)
 
 def getUserByOid(oid):
-	for user in db.iterateUsers():
-		if not user.isJoined():
+	index = _getOidIndex()
+	with oid_index_lock:
+		ids = sorted(index.get(oid, ()))
+	# ids can collide and the index isn't updated when users leave, so verify
+	for id in ids:
+		try:
+			user = db.getUser(id=id)
+		except KeyError as e:
 			continue
-		if user.getObfuscatedId() == oid:
+		if user.isJoined() and user.getObfuscatedId() == oid:
 			return user
 	return None
 
@@ -106,8 +159,7 @@ def requireUser(func):
 				return rp.Reply(rp.types.USER_NOT_IN_CHAT)
 
 		# keep db entry up to date
-		with db.modifyUser(id=user.id) as user:
-			updateUserFromEvent(user, c_user)
+		touchUserFromEvent(user, c_user)
 
 		# check for blacklist or absence
 		if user.isBlacklisted():
@@ -175,6 +227,9 @@ def user_join(c_user: IUserContainer):
 		user = db.getUser(id=c_user.id)
 	except KeyError as e:
 		user = None
+		# long-departed users may have been archived
+		if db.unarchiveUser(c_user.id):
+			user = db.getUser(id=c_user.id)
 
 	if user is not None:
 		# check if user can't rejoin
@@ -184,8 +239,7 @@ def user_join(c_user: IUserContainer):
 		elif user.isJoined():
 			err = rp.Reply(rp.types.USER_IN_CHAT)
 		if err is not None:
-			with db.modifyUser(id=user.id) as user:
-				updateUserFromEvent(user, c_user)
+			touchUserFromEvent(user, c_user)
 			return err
 
 		# user rejoins
@@ -193,6 +247,7 @@ def user_join(c_user: IUserContainer):
 		with db.modifyUser(id=user.id) as user:
 			updateUserFromEvent(user, c_user)
 			user.setLeft(False)
+		_addToOidIndex(user)
 		logging.info("%s rejoined chat", user)
 		ret = [rp.Reply(rp.types.CHAT_JOIN)]
 
@@ -212,6 +267,7 @@ def user_join(c_user: IUserContainer):
 
 	logging.info("%s joined chat", user)
 	db.addUser(user)
+	_addToOidIndex(user)
 	ret = [rp.Reply(rp.types.CHAT_JOIN)]
 
 	motd = db.getSystemConfig().motd
@@ -265,20 +321,11 @@ def get_info_mod(user: User, msid):
 
 @requireUser
 def get_users(user: User):
+	counts = db.countUsers()
 	if user.rank < RANKS.mod:
-		n = sum(1 for user2 in db.iterateUsers() if user2.isJoined())
-		return rp.Reply(rp.types.USERS_INFO, count=n)
-	active, inactive, black = 0, 0, 0
-	for user2 in db.iterateUsers():
-		if user2.isBlacklisted():
-			black += 1
-		elif not user2.isJoined():
-			inactive += 1
-		else:
-			active += 1
+		return rp.Reply(rp.types.USERS_INFO, count=counts["active"])
 	return rp.Reply(rp.types.USERS_INFO_EXTENDED,
-		active=active, inactive=inactive, blacklisted=black,
-		total=active + inactive + black)
+		total=sum(counts.values()), **counts)
 
 @requireUser
 def get_system_text(user: User, key: str):
@@ -330,8 +377,8 @@ def set_tripcode(user: User, text: str):
 		return rp.Reply(rp.types.ERR_INVALID_TRIP_FORMAT)
 
 	with db.modifyUser(id=user.id) as user:
-		user.tripcode = text
-	tripname, tripcode = genTripcode(user.tripcode)
+		user.setTripcode(text)
+	tripname, tripcode = user.getTripcode()
 	return rp.Reply(rp.types.TRIPCODE_SET, tripname=tripname, tripcode=tripcode)
 
 @requireUser
@@ -411,17 +458,8 @@ def delete_message(user: User, msid):
 @requireUser
 @requireRank(RANKS.admin)
 def cleanup_messages(user: User):
-	msids = []
-	def f(msid: int, cm: CachedMessage):
-		if cm.user_id is None:
-			return
-		if 1337 in cm.upvoted: # mark that we've been here before
-			return
-		user2 = db.getUser(id=cm.user_id)
-		if user2.isBlacklisted():
-			msids.append(msid)
-			cm.upvoted.add(1337)
-	ch.iterateMessages(f)
+	banned = db.findBlacklisted(ch.getAuthors())
+	msids = ch.markCleaned(banned)
 	logging.info("%s invoked cleanup (matched: %d)", user, len(msids))
 	Sender.delete(msids)
 	return rp.Reply(rp.types.DELETION_QUEUED, count=len(msids))
@@ -480,7 +518,6 @@ def give_karma(user: User, msid):
 	elif user.id == cm.user_id:
 		return rp.Reply(rp.types.ERR_UPVOTE_OWN_MESSAGE)
 	cm.addUpvote(user)
-	user2 = db.getUser(id=cm.user_id)
 	with db.modifyUser(id=cm.user_id) as user2:
 		user2.karma += KARMA_PLUS_ONE
 	if not user2.hideKarma:
@@ -507,10 +544,9 @@ def prepare_user_message(user: User, msg_score: int, *, is_media=False, signed=F
 
 	# enforce signing cooldown
 	if signed and sign_interval.total_seconds() > 1:
-		last_used = sign_last_used.get(user.id, None)
-		if last_used and (datetime.now() - last_used) < sign_interval:
+		if user.id in sign_last_used:
 			return rp.Reply(rp.types.ERR_SPAMMY_SIGN)
-		sign_last_used[user.id] = datetime.now()
+		sign_last_used.set(user.id, True, sign_interval.total_seconds())
 
 	return ch.assignMessageId(CachedMessage(user.id))
 
@@ -522,3 +558,61 @@ def _push_system_message(m, *, who=None, except_who=None, reply_to=None):
 	if who is None: # we only need an ID if multiple people can see the msg
 		msid = ch.assignMessageId(CachedMessage())
 	Sender.reply(m, msid, who, except_who, reply_to)
+
+###
+
+# Actions that don't originate from a Telegram user (cf. admin.py)
+
+# bans many users at once, returns (number banned, number of placeholders added)
+def admin_ban_users(entries):
+	reasons = dict((int(id), reason) for id, reason in entries)
+	with db.lockAllUsers():
+		users = db.getUsers(reasons.keys())
+		banned = list(u for u in users.values() if not u.isBlacklisted())
+		for user in banned:
+			user.setBlacklisted(reasons[user.id])
+		db.setUsers(banned)
+		# users that were never here get a placeholder entry to still ban them
+		placeholders = []
+		for id in reasons.keys() - users.keys():
+			user = User()
+			user.defaults()
+			user.id = id
+			user.realname = ""
+			user.joined = user.lastActive = datetime.utcfromtimestamp(0)
+			user.setBlacklisted(reasons[id])
+			user.left = user.joined
+			placeholders.append(user)
+		added = db.addUsers(placeholders) if len(placeholders) > 0 else 0
+	for user in banned:
+		Sender.stop_invoked(user, True)
+		logging.info("%s was blacklisted via admin socket for: %s", user, user.blacklistReason)
+	return len(banned), added
+
+# lifts bans for many users at once, returns the number of users unbanned
+def admin_unban_users(ids):
+	nodate = datetime.utcfromtimestamp(0)
+	with db.lockAllUsers():
+		users = list(u for u in db.getUsers(int(id) for id in ids).values() if u.isBlacklisted())
+		# placeholder entries are just deleted instead
+		placeholders = list(u.id for u in users if u.left == nodate)
+		users = list(u for u in users if u.left != nodate)
+		for user in users:
+			user.rank = RANKS.user
+			user.blacklistReason = None
+		db.setUsers(users)
+		deleted = db.deleteUsers(placeholders) if len(placeholders) > 0 else 0
+	for user in users:
+		logging.info("%s was unbanned via admin socket", user)
+	return len(users) + deleted
+
+def admin_set_rank(id, rank):
+	if rank not in RANKS.values() or rank < 0:
+		raise ValueError("invalid rank")
+	try:
+		with db.modifyUser(id=id) as user:
+			user.rank = rank
+	except KeyError as e:
+		return False
+	logging.info("%s had rank set via admin socket to: %d", user, rank)
+	return True
@@ -2,11 +2,16 @@ import logging
 import os
 import json
 import sqlite3
+import gzip
+import shutil
+import time
+from contextlib import contextmanager
 from datetime import date, datetime, timedelta, timezone
-from threading import RLock
-from typing import Optional, Generator
+from threading import RLock, Condition
+from typing import Optional, Generator, Dict, Iterable, Set
 
 from .globals import *
+from .util import TimedLock, metrics, genTripcode, genTripcodeCached
 
 # what's inside the database
 
@@ -14,6 +19,7 @@ class SystemConfig():
 	def __init__(self):
 		self.motd = None
 		self.privacy = None
+		self.paidBroadcasts = None # "<date> <count>", see telegram.paid_broadcast_allowed
 	def defaults(self):
 		self.motd = ""
 		self.privacy = ""
@@ -21,7 +27,7 @@ class SystemConfig():
 USER_PROPS = (
 	"id", "username", "realname", "rank", "joined", "left", "lastActive",
 	"cooldownUntil", "blacklistReason", "warnings", "warnExpiry", "karma",
-	"hideKarma", "debugEnabled", "tripcode"
+	"hideKarma", "debugEnabled", "tripcode", "tripcodeHash"
 )
 
 ID_ALPHA = "0123456789abcdefghijklmnopqrstuv"
@@ -29,6 +35,7 @@ ID_ALPHA = "0123456789abcdefghijklmnopqrstuv"
 class User():
 	__slots__ = USER_PROPS
 	global_salt = b""
+	oid_memo = (None, {}) # (day ordinal, dict(user id -> obfuscated id))
 
 	id: int
 	username: Optional[str]
@@ -45,11 +52,13 @@ class User():
 	hideKarma: bool
 	debugEnabled: bool
 	tripcode: Optional[str]
+	tripcodeHash: Optional[str] # derived from `tripcode`, see setTripcode
 
 	@staticmethod
 	def setSalt(salt):
 		assert all(isinstance(v, int) for v in salt)
 		User.global_salt = salt
+		User.oid_memo = (None, {})
 	def __init__(self):
 		for k in USER_PROPS:
 			setattr(self, k, None)
@@ -75,14 +84,30 @@ class User():
 		return self.rank < 0
 	def getObfuscatedId(self):
 		salt = date.today().toordinal()
-		value = fnv32a([self.id, salt], [User.global_salt])
-		# stringify 20 bits
-		return ''.join(ID_ALPHA[n%32] for n in (value, value>>5, value>>10, value>>15))
+		memo = User.oid_memo
+		if memo[0] != salt:
+			memo = User.oid_memo = (salt, {})
+		ret = memo[1].get(self.id)
+		if ret is None:
+			value = fnv32a([self.id, salt], [User.global_salt])
+			# stringify 20 bits
+			ret = ''.join(ID_ALPHA[n%32] for n in (value, value>>5, value>>10, value>>15))
+			memo[1][self.id] = ret
+		return ret
 	def getObfuscatedKarma(self):
 		for cutoff in (100, 50, 10):
 			if abs(self.karma) >= cutoff:
 				return max(-cutoff, min(self.karma, cutoff))
 		return 0
+	def setTripcode(self, tripcode):
+		self.tripcode = tripcode
+		self.tripcodeHash = None if tripcode is None else genTripcode(tripcode)[1]
+	# returns (tripname, tripcode) for display
+	def getTripcode(self):
+		if self.tripcodeHash is None:
+			# user from before this was stored
+			return genTripcodeCached(self.tripcode)
+		return self.tripcode.partition("#")[0], self.tripcodeHash
 	def getFormattedName(self):
 		if self.username is not None:
 			return "@" + self.username
@@ -139,34 +164,160 @@ class ModificationContext():
 
 class Database():
 	def __init__(self):
-		self.lock = RLock()
+		self.lock = TimedLock()
+		# modifications of users are serialized by lock striping on the user id,
+		# `lock` then only protects the backend itself for a short time
+		self.user_locks = [RLock() for _ in range(64)]
+		self.dirty = {} # maps user id -> dict(prop -> value) of deferred changes
 		assert self.__class__ != Database # do not instantiate directly
 	def register_tasks(self, sched):
 		raise NotImplementedError()
 	def close(self):
 		raise NotImplementedError()
-	def getUser(self, *, id: Optional[int]=None) -> User:
+	# lookup by username only considers joined users and is case-insensitive
+	def getUser(self, *, id: Optional[int]=None, username: Optional[str]=None) -> User:
 		raise NotImplementedError()
 	def setUser(self, id: int, user: User):
 		raise NotImplementedError()
 	def addUser(self, user: User):
 		raise NotImplementedError()
+	# adds many users at once, skipping ids that already exist
+	# returns the number of users added
+	def addUsers(self, users: 'list[User]') -> int:
+		# fallback impl
+		n = 0
+		with self.lock:
+			for user in users:
+				try:
+					self.getUser(id=user.id)
+				except KeyError as e:
+					self.addUser(user)
+					n += 1
+		return n
+	# returns the users that exist among the given ids, mapped by id
+	def getUsers(self, ids: Iterable[int]) -> Dict[int, User]:
+		# fallback impl
+		ret = {}
+		for id in ids:
+			try:
+				ret[id] = self.getUser(id=id)
+			except KeyError as e:
+				pass
+		return ret
+	# writes many existing users at once
+	def setUsers(self, users: 'list[User]'):
+		# fallback impl
+		with self.lock:
+			for user in users:
+				self.setUser(user.id, user)
+	# removes users entirely, returns the number of users deleted
+	def deleteUsers(self, ids: Iterable[int]) -> int:
+		raise NotImplementedError()
+	# returns users with a rank above a normal user, optionally only of `rank`
+	def getPrivilegedUsers(self, rank: Optional[int]=None) -> 'list[User]':
+		# fallback impl
+		return list(u for u in self.iterateUsers() if u.rank > 0 and (rank is None or u.rank == rank))
+	# case-insensitive substring search on username and realname,
+	# a numeric term also matches the id
+	def findUsers(self, term: str) -> 'list[User]':
+		# fallback impl
+		term = term.lower()
+		return list(u for u in self.iterateUsers() if term in (u.username or "").lower() or
+			term in u.realname.lower() or term == str(u.id))
 	def iterateUserIds(self) -> Generator[int, None, None]:
 		raise NotImplementedError()
 	def getSystemConfig(self) -> Optional[SystemConfig]:
 		raise NotImplementedError()
 	def setSystemConfig(self, config: SystemConfig):
 		raise NotImplementedError()
+	# defer a non-critical change to a user (e.g. activity), it will be
+	# written in a batch by flushUsers()
+	def updateUserLazy(self, id: int, **props):
+		with self.lock:
+			self.dirty.setdefault(id, {}).update(props)
+	def flushUsers(self):
+		with self.lock:
+			if len(self.dirty) == 0:
+				return
+			changes, self.dirty = self.dirty, {}
+			self._writeUserProps(changes)
+	def _writeUserProps(self, changes: Dict[int, dict]):
+		# fallback impl
+		for id, props in changes.items():
+			try:
+				user = self.getUser(id=id)
+			except KeyError as e:
+				continue
+			for k, v in props.items():
+				setattr(user, k, v)
+			self.setUser(id, user)
+	# apply deferred changes to a user that was just read from storage
+	def _overlay(self, user: User) -> User:
+		props = self.dirty.get(user.id)
+		if props is not None:
+			for k, v in props.items():
+				setattr(user, k, v)
+		return user
 	def iterateUsers(self) -> Generator[User, None, None]:
 		# fallback impl
 		with self.lock:
 			l = list(self.getUser(id=id) for id in self.iterateUserIds())
 		yield from l
+	def countUsers(self) -> Dict[str, int]:
+		# fallback impl
+		ret = {"active": 0, "inactive": 0, "blacklisted": 0}
+		for user in self.iterateUsers():
+			ret[Database._userState(user.rank, user.left)] += 1
+		return ret
+	@staticmethod
+	def _userState(rank, left):
+		if rank < 0:
+			return "blacklisted"
+		return "inactive" if left is not None else "active"
+	def removeExpiredWarnings(self, now: datetime) -> int:
+		# fallback impl
+		with self.lockAllUsers(), self.lock:
+			l = list(u for u in self.iterateUsers() if u.isJoined() and
+				u.warnExpiry is not None and now >= u.warnExpiry)
+			for user in l:
+				user.removeWarning()
+				self.setUser(user.id, user)
+		return len(l)
+	# returns which of the given user ids are blacklisted
+	def findBlacklisted(self, ids: Iterable[int]) -> Set[int]:
+		# fallback impl
+		ret = set()
+		for id in ids:
+			try:
+				if self.getUser(id=id).isBlacklisted():
+					ret.add(id)
+			except KeyError as e:
+				pass
+		return ret
+	# moves a user back from cold storage (see retention policy), returns
+	# whether there was anything to restore
+	def unarchiveUser(self, id: int) -> bool:
+		# fallback impl: backend has no archive
+		return False
 	def modifyUser(self, *, id: Optional[int]=None):
-		with self.lock:
+		if id is None:
+			raise ValueError()
+		lock = self.user_locks[id % len(self.user_locks)]
+		with lock:
 			user = self.getUser(id=id)
 			callback = lambda newuser: self.setUser(user.id, newuser)
-			return ModificationContext(user, callback, self.lock)
+			return ModificationContext(user, callback, lock)
+	# for bulk modifications: excludes all concurrent modifyUser() calls
+	# (always acquire this *before* `lock`)
+	@contextmanager
+	def lockAllUsers(self):
+		for lock in self.user_locks:
+			lock.acquire()
+		try:
+			yield
+		finally:
+			for lock in reversed(self.user_locks):
+				lock.release()
 	def modifySystemConfig(self):
 		with self.lock:
 			config = self.getSystemConfig()
@@ -186,18 +337,19 @@ class JSONDatabase(Database):
 			pass
 		logging.warning("The JSON backend is meant for development only!")
 	def register_tasks(self, sched):
-		return
+		sched.register(self.flushUsers, name="db_flush", background=True, seconds=5)
 	def close(self):
-		return
+		self.flushUsers()
 	@staticmethod
 	def _systemConfigToDict(config):
-		return {"motd": config.motd, "privacy": config.privacy}
+		return {"motd": config.motd, "privacy": config.privacy, "paid_broadcasts": config.paidBroadcasts}
 	@staticmethod
 	def _systemConfigFromDict(d):
 		if d is None: return None
 		config = SystemConfig()
 		config.motd = d["motd"]
 		config.privacy = d.get("privacy")
+		config.paidBroadcasts = d.get("paid_broadcasts")
 		return config
 	@staticmethod
 	def _userToDict(user):
@@ -213,7 +365,7 @@ class JSONDatabase(Database):
 		if d is None: return None
 		props = ["id", "username", "realname", "rank", "blacklistReason",
 			"warnings", "karma", "hideKarma", "debugEnabled"]
-		props_d = {"tripcode": None}
+		props_d = {"tripcode": None, "tripcodeHash": None}
 		dateprops = ["joined", "left", "lastActive", "cooldownUntil", "warnExpiry"]
 		assert set(props).union(props_d.keys()).union(dateprops) == set(USER_PROPS)
 		user = User()
@@ -234,13 +386,18 @@ class JSONDatabase(Database):
 			with open(self.path + "~", "w") as f:
 				json.dump(self.db, f)
 			os.replace(self.path + "~", self.path)
-	def getUser(self, *, id=None):
-		if id is None:
+	def getUser(self, *, id=None, username=None):
+		if id is not None:
+			match = lambda u: u["id"] == id
+		elif username is not None:
+			username = username.lower()
+			match = lambda u: u["left"] is None and (u["username"] or "").lower() == username
+		else:
 			raise ValueError()
 		with self.lock:
-			gen = (u for u in self.db["users"] if u["id"] == id)
+			gen = (u for u in self.db["users"] if match(u))
 			try:
-				return JSONDatabase._userFromDict(next(gen))
+				return self._overlay(JSONDatabase._userFromDict(next(gen)))
 			except StopIteration as e:
 				raise KeyError()
 	def setUser(self, id, newuser):
@@ -251,15 +408,57 @@ class JSONDatabase(Database):
 					self.db["users"][i] = newuser
 					self._save()
 					return
+	def _writeUserProps(self, changes):
+		with self.lock:
+			for d in self.db["users"]:
+				props = changes.get(d["id"])
+				if props is None:
+					continue
+				for k, v in props.items():
+					if isinstance(v, datetime):
+						v = int(v.replace(tzinfo=timezone.utc).timestamp())
+					d[k] = v
+			self._save()
 	def addUser(self, newuser):
 		newuser = JSONDatabase._userToDict(newuser)
 		with self.lock:
 			self.db["users"].append(newuser)
 			self._save()
+	def deleteUsers(self, ids):
+		ids = set(ids)
+		with self.lock:
+			n = len(self.db["users"])
+			self.db["users"] = list(u for u in self.db["users"] if u["id"] not in ids)
+			n -= len(self.db["users"])
+			for id in ids:
+				self.dirty.pop(id, None)
+			if n > 0:
+				self._save()
+		return n
 	def iterateUserIds(self):
 		with self.lock:
 			l = list(u["id"] for u in self.db["users"])
 		yield from l
+	def countUsers(self):
+		ret = {"active": 0, "inactive": 0, "blacklisted": 0}
+		with self.lock:
+			for u in self.db["users"]:
+				ret[Database._userState(u["rank"], u["left"])] += 1
+		return ret
+	def removeExpiredWarnings(self, now):
+		ts = int(now.replace(tzinfo=timezone.utc).timestamp())
+		n = 0
+		with self.lockAllUsers(), self.lock:
+			for i, d in enumerate(self.db["users"]):
+				if d["left"] is not None or d["warnExpiry"] is None or ts < d["warnExpiry"]:
+					continue
+				user = JSONDatabase._userFromDict(d)
+				user.removeWarning()
+				self.db["users"][i] = JSONDatabase._userToDict(user)
+				n += 1
+			if n > 0:
+				self._save()
+		return n
 	def getSystemConfig(self):
 		with self.lock:
 			return JSONDatabase._systemConfigFromDict(self.db["systemConfig"])
@@ -268,58 +467,311 @@ class JSONDatabase(Database):
 			self.db["systemConfig"] = JSONDatabase._systemConfigToDict(config)
 			self._save()
 
-# SQLite implementation
+# In-memory implementation
+# Optionally snapshots to disk in the same format as the JSON backend.
 
-class SQLiteDatabase(Database):
+class MemoryDatabase(Database):
+	def __init__(self, path=None, snapshot_interval=300):
+		super().__init__()
+		self.path = path
+		self.snapshot_interval = snapshot_interval
+		self.users = {} # dict(id -> User)
+		self.names = {} # dict(lowercase username -> set of ids)
+		self.systemConfig = None
+		self.changed = False
+		if self.path is not None:
+			try:
+				self._load()
+			except FileNotFoundError as e:
+				pass
+	def register_tasks(self, sched):
+		if self.path is not None:
+			sched.register(self.snapshot, name="db_snapshot", background=True, seconds=self.snapshot_interval)
+	def close(self):
+		self.snapshot()
+	@staticmethod
+	def _copy(user):
+		ret = User()
+		for prop in USER_PROPS:
+			setattr(ret, prop, getattr(user, prop))
+		return ret
+	def _load(self):
+		with open(self.path, "r") as f:
+			d = json.load(f)
+		with self.lock:
+			self.systemConfig = JSONDatabase._systemConfigFromDict(d["systemConfig"])
+			for u in d["users"]:
+				self._put(JSONDatabase._userFromDict(u))
+	def snapshot(self):
+		if self.path is None:
+			return
+		with self.lock:
+			if not self.changed:
+				return
+			d = {
+				"systemConfig": None,
+				"users": list(JSONDatabase._userToDict(u) for u in self.users.values()),
+			}
+			if self.systemConfig is not None:
+				d["systemConfig"] = JSONDatabase._systemConfigToDict(self.systemConfig)
+			self.changed = False
+		with open(self.path + "~", "w") as f:
+			json.dump(d, f)
+		os.replace(self.path + "~", self.path)
+		logging.debug("Wrote database snapshot (%d users)", len(d["users"]))
+	# insert or replace user object (must hold lock)
+	def _put(self, user):
+		old = self.users.get(user.id)
+		if old is not None and old.username is not None:
+			self.names[old.username.lower()].discard(user.id)
+		if user.username is not None:
+			self.names.setdefault(user.username.lower(), set()).add(user.id)
+		self.users[user.id] = user
+		self.changed = True
+	def getUser(self, *, id=None, username=None):
+		with self.lock:
+			if id is not None:
+				user = self.users.get(id)
+			elif username is not None:
+				ids = self.names.get(username.lower(), ())
+				user = next((self.users[i] for i in ids if self.users[i].isJoined()), None)
+			else:
+				raise ValueError()
+			if user is None:
+				raise KeyError()
+			return MemoryDatabase._copy(user)
+	def setUser(self, id, newuser):
+		with self.lock:
+			if id in self.users.keys():
+				self._put(MemoryDatabase._copy(newuser))
+	def updateUserLazy(self, id, **props):
+		# no reason to defer anything
+		with self.lock:
+			user = self.users.get(id)
+			if user is not None:
+				user = MemoryDatabase._copy(user)
+				for k, v in props.items():
+					setattr(user, k, v)
+				self._put(user)
+	def addUser(self, newuser):
+		with self.lock:
+			self._put(MemoryDatabase._copy(newuser))
+	def deleteUsers(self, ids):
+		n = 0
+		with self.lock:
+			for id in ids:
+				user = self.users.pop(id, None)
+				if user is None:
+					continue
+				if user.username is not None:
+					self.names[user.username.lower()].discard(id)
+				n += 1
+			if n > 0:
+				self.changed = True
+		return n
+	def iterateUserIds(self):
+		with self.lock:
+			l = list(self.users.keys())
+		yield from l
+	def iterateUsers(self):
+		with self.lock:
+			l = list(MemoryDatabase._copy(u) for u in self.users.values())
+		yield from l
+	def countUsers(self):
+		ret = {"active": 0, "inactive": 0, "blacklisted": 0}
+		with self.lock:
+			for u in self.users.values():
+				ret[Database._userState(u.rank, u.left)] += 1
+		return ret
+	def removeExpiredWarnings(self, now):
+		with self.lockAllUsers(), self.lock:
+			l = list(u for u in self.users.values() if u.isJoined() and
+				u.warnExpiry is not None and now >= u.warnExpiry)
+			for user in l:
+				user.removeWarning()
+			if len(l) > 0:
+				self.changed = True
+		return len(l)
+	def getSystemConfig(self):
+		with self.lock:
+			if self.systemConfig is None:
+				return None
+			config = SystemConfig()
+			config.motd = self.systemConfig.motd
+			config.privacy = self.systemConfig.privacy
+			return config
+	def setSystemConfig(self, config):
+		with self.lock:
+			self.systemConfig = SystemConfig()
+			self.systemConfig.motd = config.motd
+			self.systemConfig.privacy = config.privacy
+			self.changed = True
+
+# Log-structured implementation
+# Every change is appended to the file as a JSON line, which is replayed on
+# startup. The log is periodically compacted into a snapshot of all records.
+
+class LogDatabase(Database):
 	def __init__(self, path):
 		super().__init__()
-		self.db = sqlite3.connect(path, check_same_thread=False,
-			detect_types=sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES)
-		self.db.row_factory = sqlite3.Row
-		self._ensure_schema()
+		self.path = path
+		self.users = {} # dict(id -> user as dict)
+		self.systemConfig = None
+		self.entries = 0 # number of entries in the log file
+		self._replay()
+		self.f = open(self.path, "a")
 	def register_tasks(self, sched):
-		def f():
-			with self.lock:
-				self.db.commit()
-		sched.register(f, seconds=5)
+		sched.register(self.flushUsers, name="db_flush", background=True, seconds=5)
+		sched.register(self.compact, name="db_compact", background=True, minutes=15)
 	def close(self):
+		self.flushUsers()
 		with self.lock:
-			self.db.commit()
-			self.db.close()
-	@staticmethod
-	def _systemConfigToDict(config):
-		return {"motd": config.motd, "privacy": config.privacy}
-	@staticmethod
-	def _systemConfigFromDict(d):
-		if len(d) == 0: return None
-		config = SystemConfig()
-		config.motd = d["motd"]
-		config.privacy = d.get("privacy")
-		return config
+			self.f.close()
 	@staticmethod
-	def _userToDict(user):
-		return {prop: getattr(user, prop) for prop in USER_PROPS}
-	@staticmethod
-	def _userFromRow(r):
-		user = User()
-		for prop in r.keys():
-			setattr(user, prop, r[prop])
-		return user
-	def _ensure_schema(self):
-		def row_exists(table, name):
-			cur = self.db.execute("PRAGMA table_info(`" + table + "`);")
-			return any(row[1] == name for row in cur)
-
+	def _encode(props):
+		ret = {}
+		for k, v in props.items():
+			if isinstance(v, datetime):
+				v = int(v.replace(tzinfo=timezone.utc).timestamp())
+			ret[k] = v
+		return ret
+	def _apply(self, e):
+		if e["t"] == "user":
+			self.users[e["d"]["id"]] = e["d"]
+		elif e["t"] == "props":
+			if e["id"] in self.users.keys():
+				self.users[e["id"]].update(e["d"])
+		elif e["t"] == "delete":
+			self.users.pop(e["id"], None)
+		elif e["t"] == "config":
+			self.systemConfig = e["d"]
+		else:
+			raise ValueError("unknown log entry type %r" % e["t"])
+	def _replay(self):
+		try:
+			f = open(self.path, "rb")
+		except FileNotFoundError as e:
+			return
+		good = 0
+		with f:
+			for line in f:
+				if not line.endswith(b"\n"):
+					break # incomplete write at the end
+				self._apply(json.loads(line))
+				good += len(line)
+				self.entries += 1
+		size = os.path.getsize(self.path)
+		if good < size:
+			logging.warning("Discarding %d bytes of incomplete log entry", size - good)
+			os.truncate(self.path, good)
+	def _append(self, e):
+		with self.lock:
+			self._apply(e)
+			self.f.write(json.dumps(e, separators=(",", ":")) + "\n")
+			self.f.flush()
+			self.entries += 1
+	def compact(self, force=False):
+		with self.lock:
+			live = len(self.users) + 1
+			if not force and self.entries < 2 * live + 1000:
+				return
+			with open(self.path + "~", "w") as f:
+				if self.systemConfig is not None:
+					f.write(json.dumps({"t": "config", "d": self.systemConfig}, separators=(",", ":")) + "\n")
+				for d in self.users.values():
+					f.write(json.dumps({"t": "user", "d": d}, separators=(",", ":")) + "\n")
+				f.flush()
+				os.fsync(f.fileno())
+			self.f.close()
+			os.replace(self.path + "~", self.path)
+			self.f = open(self.path, "a")
+			logging.debug("Compacted database log from %d to %d entries", self.entries, live)
+			self.entries = live
+	def getUser(self, *, id=None, username=None):
+		with self.lock:
+			if id is not None:
+				d = self.users.get(id)
+			elif username is not None:
+				username = username.lower()
+				gen = (u for u in self.users.values() if u["left"] is None and
+					(u["username"] or "").lower() == username)
+				d = next(gen, None)
+			else:
+				raise ValueError()
+			if d is None:
+				raise KeyError()
+			return self._overlay(JSONDatabase._userFromDict(d))
+	def setUser(self, id, newuser):
+		if id not in self.users.keys():
+			return
+		self._append({"t": "user", "d": JSONDatabase._userToDict(newuser)})
+	def _writeUserProps(self, changes):
+		with self.lock:
+			for id, props in changes.items():
+				self._append({"t": "props", "id": id, "d": LogDatabase._encode(props)})
+	def addUser(self, newuser):
+		self._append({"t": "user", "d": JSONDatabase._userToDict(newuser)})
+	def deleteUsers(self, ids):
+		n = 0
+		with self.lock:
+			for id in ids:
+				self.dirty.pop(id, None)
+				if id in self.users.keys():
+					self._append({"t": "delete", "id": id})
+					n += 1
+		return n
+	def iterateUserIds(self):
+		with self.lock:
+			l = list(self.users.keys())
+		yield from l
+	def iterateUsers(self):
 		with self.lock:
-			# create initial schema
-			self.db.execute("""
+			l = list(self._overlay(JSONDatabase._userFromDict(d)) for d in self.users.values())
+		yield from l
+	def countUsers(self):
+		ret = {"active": 0, "inactive": 0, "blacklisted": 0}
+		with self.lock:
+			for u in self.users.values():
+				ret[Database._userState(u["rank"], u["left"])] += 1
+		return ret
+	def removeExpiredWarnings(self, now):
+		ts = int(now.replace(tzinfo=timezone.utc).timestamp())
+		n = 0
+		with self.lockAllUsers(), self.lock:
+			l = list(d for d in self.users.values() if d["left"] is None and
+				d["warnExpiry"] is not None and ts >= d["warnExpiry"])
+			for d in l:
+				user = JSONDatabase._userFromDict(d)
+				user.removeWarning()
+				props = {"warnings": user.warnings, "warnExpiry": user.warnExpiry}
+				self._append({"t": "props", "id": user.id, "d": LogDatabase._encode(props)})
+				n += 1
+		return n
+	def getSystemConfig(self):
+		with self.lock:
+			return JSONDatabase._systemConfigFromDict(self.systemConfig)
+	def setSystemConfig(self, config):
+		self._append({"t": "config", "d": JSONDatabase._systemConfigToDict(config)})
+
+# SQLite implementation
+
+# SQLite schema migrations: entry N upgrades the schema from version N to N+1,
+# the current version is stored in PRAGMA user_version
+
+def _migrate_initial(db):
+	def row_exists(table, name):
+		cur = db.execute("PRAGMA table_info(`" + table + "`);")
+		return any(row[1] == name for row in cur)
+
+	# (databases from before versioning already have these)
+	db.execute("""
 CREATE TABLE IF NOT EXISTS `system_config` (
 	`name` TEXT NOT NULL,
 	`value` TEXT NOT NULL,
 	PRIMARY KEY (`name`)
 );
-			""".strip())
-			self.db.execute("""
+	""".strip())
+	db.execute("""
 CREATE TABLE IF NOT EXISTS `users` (
 	`id` BIGINT NOT NULL,
 	`username` TEXT,
@@ -338,57 +790,444 @@ CREATE TABLE IF NOT EXISTS `users` (
 	`tripcode` TEXT,
 	PRIMARY KEY (`id`)
 );
-			""".strip())
-			# migration
-			if not row_exists("users", "tripcode"):
-				self.db.execute("ALTER TABLE `users` ADD `tripcode` TEXT")
-	def getUser(self, *, id=None):
-		if id is None:
-			raise ValueError()
-		sql = "SELECT * FROM users WHERE id = ?"
-		param = id
+	""".strip())
+	if not row_exists("users", "tripcode"):
+		db.execute("ALTER TABLE `users` ADD `tripcode` TEXT")
+
+def _migrate_indexes(db):
+	# joined users: warning expiry sweep and lookup by username
+	db.execute("""
+CREATE INDEX IF NOT EXISTS `users_warnExpiry` ON `users` (`warnExpiry`)
+	WHERE `left` IS NULL AND `warnExpiry` IS NOT NULL;
+	""".strip())
+	db.execute("""
+CREATE INDEX IF NOT EXISTS `users_username` ON `users` (`username` COLLATE NOCASE)
+	WHERE `left` IS NULL;
+	""".strip())
+	# banned users: blacklist sync in util/blacklist.py
+	db.execute("""
+CREATE INDEX IF NOT EXISTS `users_banned` ON `users` (`left`)
+	WHERE `rank` = -10;
+	""".strip())
+	# privileged users: util/perms.py
+	db.execute("""
+CREATE INDEX IF NOT EXISTS `users_privileged` ON `users` (`rank`)
+	WHERE `rank` > 0;
+	""".strip())
+
+def _migrate_archive(db):
+	# long-departed users are moved here by the retention policy,
+	# NOTE: columns added to `users` later need to be added here too
+	db.execute("""
+CREATE TABLE IF NOT EXISTS `users_archive` (
+	`id` BIGINT NOT NULL,
+	`username` TEXT,
+	`realname` TEXT NOT NULL,
+	`rank` INTEGER NOT NULL,
+	`joined` TIMESTAMP NOT NULL,
+	`left` TIMESTAMP,
+	`lastActive` TIMESTAMP NOT NULL,
+	`cooldownUntil` TIMESTAMP,
+	`blacklistReason` TEXT,
+	`warnings` INTEGER NOT NULL,
+	`warnExpiry` TIMESTAMP,
+	`karma` INTEGER NOT NULL,
+	`hideKarma` TINYINT NOT NULL,
+	`debugEnabled` TINYINT NOT NULL,
+	`tripcode` TEXT,
+	PRIMARY KEY (`id`)
+);
+	""".strip())
+
+def _migrate_tripcode_hash(db):
+	# store the derived tripcode so crypt() doesn't run for every message
+	for table in ("users", "users_archive"):
+		db.execute("ALTER TABLE `%s` ADD `tripcodeHash` TEXT" % table)
+		rows = db.execute("SELECT `id`, `tripcode` FROM `%s` WHERE `tripcode` IS NOT NULL" % table).fetchall()
+		db.executemany("UPDATE `%s` SET `tripcodeHash` = ? WHERE `id` = ?" % table,
+			((genTripcode(row[1])[1], row[0]) for row in rows))
+
+SQLITE_MIGRATIONS = [
+	_migrate_initial,
+	_migrate_indexes,
+	_migrate_archive,
+	_migrate_tripcode_hash,
+]
+
+SQLITE_SYNCHRONOUS = ("off", "normal", "full", "extra")
+SQLITE_MAX_READERS = 4
+# build these once so the statement cache can reuse them
+SQL_SET_USER = "UPDATE users SET " + ", ".join("`%s` = ?" % k for k in USER_PROPS[1:]) + " WHERE id = ?"
+SQL_ADD_USER = "INSERT INTO users(" + ", ".join("`%s`" % k for k in USER_PROPS) + ") VALUES (" + ", ".join("?" for k in USER_PROPS) + ")"
+SQL_ADD_USERS = SQL_ADD_USER.replace("INSERT", "INSERT OR IGNORE", 1)
+SQL_USER_COLS = ", ".join("`%s`" % k for k in USER_PROPS)
+assert USER_PROPS[0] == "id"
+
+class SQLiteDatabase(Database):
+	# `commit_interval`: seconds between commits, 0 means commit after every write
+	# `synchronous`: value for PRAGMA synchronous (durability level)
+	# `backup_dir`: if set, take an online backup every `backup_interval` minutes,
+	# keeping the newest `backup_keep` of them
+	# `retention_days`: if set, users that left (and aren't banned or privileged)
+	# longer ago than this are moved to the archive table
+	def __init__(self, path, *, commit_interval=1, synchronous="normal",
+		backup_dir=None, backup_interval=60, backup_keep=24, backup_compress=False,
+		retention_days=None):
+		super().__init__()
+		if synchronous.lower() not in SQLITE_SYNCHRONOUS:
+			raise ValueError("invalid synchronous value %r" % synchronous)
+		self.path = path
+		self.commit_interval = commit_interval
+		self.synchronous = synchronous
+		self.backup_dir = backup_dir
+		self.backup_interval = backup_interval
+		self.backup_keep = backup_keep
+		self.backup_compress = backup_compress
+		self.retention_days = retention_days
+		self.db = self._connect(path)
+		# only has an effect on new databases, see _enableIncrementalVacuum
+		self.db.execute("PRAGMA auto_vacuum = INCREMENTAL")
+		# pool of read connections shared by all threads
+		self.readers = [] # all of them
+		self.idle_readers = []
+		self.reader_cond = Condition()
+		self.wal = self.db.execute("PRAGMA journal_mode = WAL").fetchone()[0].lower() == "wal"
+		self.db.execute("PRAGMA synchronous = " + synchronous)
+		self._ensure_schema()
+		self.db.commit()
+		if self.retention_days is not None:
+			self._enableIncrementalVacuum()
+	def _connect(self, path, readonly=False):
+		t = sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES
+		if readonly:
+			path = "file:" + path + "?mode=ro"
+		conn = sqlite3.connect(path, check_same_thread=False, detect_types=t,
+			cached_statements=256, uri=readonly)
+		conn.row_factory = sqlite3.Row
+		return conn
+	def register_tasks(self, sched):
+		def f():
+			with self.lock:
+				self.flushUsers()
+				self.db.commit()
+		sched.register(f, name="db_commit", background=True, seconds=self.commit_interval or 5)
+		if self.backup_dir is not None:
+			sched.register(self.rotateBackups, name="db_backup", background=True, minutes=self.backup_interval)
+		if self.retention_days is not None:
+			sched.register(self.applyRetention, name="db_retention", background=True, jitter=600, hours=6)
+	def close(self):
 		with self.lock:
-			cur = self.db.execute(sql, (param, ))
-			row = cur.fetchone()
-		if row is None:
+			self.flushUsers()
+			self.db.commit()
+			with self.reader_cond:
+				for conn in self.readers:
+					conn.close()
+			self.db.close()
+	# copies the database to `dest` using the online backup API, `pages` at a time.
+	# the writer connection is the source so sqlite keeps the copy up to date
+	# with writes that happen in between, the lock is only held during a step.
+	def backup(self, dest, pages=256):
+		stats = {"steps": 0, "lock_total": 0.0, "lock_max": 0.0}
+		target = sqlite3.connect(dest)
+		def step_done(status, remaining, total):
+			held = time.monotonic() - stats["acquired"]
+			stats["steps"] += 1
+			stats["lock_total"] += held
+			stats["lock_max"] = max(stats["lock_max"], held)
+			self.lock.release()
+			time.sleep(0.005) # let waiting threads in
+			self.lock.acquire()
+			stats["acquired"] = time.monotonic()
+			self.db.commit() # a step can't run during an open write transaction
+		start = time.monotonic()
+		try:
+			with self.lock:
+				self.flushUsers()
+				self.db.commit()
+				stats["acquired"] = time.monotonic()
+				self.db.backup(target, pages=pages, progress=step_done)
+			target.execute("PRAGMA journal_mode = DELETE") # self-contained file
+		finally:
+			target.close()
+		stats["duration"] = time.monotonic() - start
+		stats["size"] = os.path.getsize(dest)
+		return stats
+	# takes a backup into `backup_dir` and deletes the oldest ones beyond `backup_keep`
+	def rotateBackups(self):
+		os.makedirs(self.backup_dir, exist_ok=True)
+		prefix = os.path.splitext(os.path.basename(self.path))[0] + "-"
+		name = prefix + datetime.now().strftime("%Y%m%d-%H%M%S") + ".sqlite"
+		dest = os.path.join(self.backup_dir, name)
+		stats = self.backup(dest + ".tmp")
+		if self.backup_compress:
+			with open(dest + ".tmp", "rb") as fin, gzip.open(dest + ".gz.tmp", "wb") as fout:
+				shutil.copyfileobj(fin, fout)
+			os.remove(dest + ".tmp")
+			dest += ".gz"
+		os.replace(dest + ".tmp", dest)
+		logging.info("Backed up database to %s: %.1f MB in %.1fs (%.1f MB/s), "
+			"lock held %.3fs total, %.3fs max over %d steps",
+			dest, stats["size"] / 1e6, stats["duration"],
+			stats["size"] / 1e6 / max(stats["duration"], 1e-3),
+			stats["lock_total"], stats["lock_max"], stats["steps"])
+		metrics.set("db.backup.duration", round(stats["duration"], 3))
+		metrics.set("db.backup.lock_max", round(stats["lock_max"], 3))
+		old = sorted(e for e in os.listdir(self.backup_dir)
+			if e.startswith(prefix) and e.endswith((".sqlite", ".sqlite.gz")))
+		for e in old[:-self.backup_keep]:
+			os.remove(os.path.join(self.backup_dir, e))
+	# existing databases need a full VACUUM once to switch the mode
+	def _enableIncrementalVacuum(self):
+		with self.lock:
+			if self.db.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+				return
+			logging.info("Enabling incremental vacuum, this rewrites the database once")
+			self.db.execute("PRAGMA auto_vacuum = INCREMENTAL")
+			self.db.execute("VACUUM")
+	# moves long-departed users to `users_archive` and gives the freed pages back,
+	# both in small batches so the lock is never held for long
+	def applyRetention(self, batch_size=1000, vacuum_pages=1000):
+		before = datetime.now() - timedelta(days=self.retention_days)
+		self.flushUsers()
+		archived = 0
+		last = -2**63
+		while True:
+			with self.lock:
+				# walk the table by primary key so each batch only looks at its own rows
+				sql = "SELECT `id`, `rank` = 0 AND `left` < ? FROM users WHERE `id` > ? ORDER BY `id` LIMIT ?"
+				rows = self.db.execute(sql, (before, last, batch_size)).fetchall()
+				ids = list(row[0] for row in rows if row[1])
+				if len(ids) > 0:
+					cond = " WHERE id IN (" + ",".join("?" for _ in ids) + ")"
+					self.db.execute("INSERT OR REPLACE INTO users_archive (" + SQL_USER_COLS +
+						") SELECT " + SQL_USER_COLS + " FROM users" + cond, ids)
+					self.db.execute("DELETE FROM users" + cond, ids)
+				self.db.commit()
+			archived += len(ids)
+			if len(rows) < batch_size:
+				break
+			last = rows[-1][0]
+		freed = 0
+		while True:
+			with self.lock:
+				free = self.db.execute("PRAGMA freelist_count").fetchone()[0]
+				if free == 0:
+					break
+				self.db.execute("PRAGMA incremental_vacuum(%d)" % vacuum_pages)
+				self.db.commit()
+			freed += min(free, vacuum_pages)
+		counts = {}
+		for table in ("users", "users_archive"):
+			counts[table] = self._read("SELECT COUNT(*) FROM " + table)[0][0]
+		pages = self._read("PRAGMA page_count")[0][0]
+		logging.info("Retention: archived %d users, freed %d pages; %d users, "
+			"%d archived, %d pages in total", archived, freed, counts["users"],
+			counts["users_archive"], pages)
+		metrics.set("db.users", counts["users"])
+		metrics.set("db.users_archive", counts["users_archive"])
+		metrics.set("db.pages", pages)
+	def unarchiveUser(self, id):
+		with self.lock:
+			cur = self.db.execute("INSERT OR IGNORE INTO users (" + SQL_USER_COLS + ") SELECT " +
+				SQL_USER_COLS + " FROM users_archive WHERE id = ?", (id, ))
+			if cur.rowcount <= 0:
+				return False
+			self.db.execute("DELETE FROM users_archive WHERE id = ?", (id, ))
+			self.db.commit()
+		return True
+	# commit now if the commit policy says so (must hold lock)
+	def _written(self):
+		if self.commit_interval == 0:
+			self.db.commit()
+	# checks out a connection for reading, at most SQLITE_MAX_READERS exist
+	def _getReader(self):
+		with self.reader_cond:
+			while len(self.idle_readers) == 0 and len(self.readers) >= SQLITE_MAX_READERS:
+				self.reader_cond.wait()
+			if len(self.idle_readers) > 0:
+				return self.idle_readers.pop()
+			conn = self._connect(self.path, readonly=True)
+			self.readers.append(conn)
+			return conn
+	def _putReader(self, conn):
+		with self.reader_cond:
+			self.idle_readers.append(conn)
+			self.reader_cond.notify()
+	def _read(self, sql, param=()):
+		# readers can't see uncommitted data, so fall back to the writer then
+		if not self.wal or self.db.in_transaction:
+			with self.lock:
+				return self.db.execute(sql, param).fetchall()
+		conn = self._getReader()
+		try:
+			return conn.execute(sql, param).fetchall()
+		finally:
+			self._putReader(conn)
+	@staticmethod
+	def _systemConfigToDict(config):
+		return {"motd": config.motd, "privacy": config.privacy, "paid_broadcasts": config.paidBroadcasts}
+	@staticmethod
+	def _systemConfigFromDict(d):
+		if len(d) == 0: return None
+		config = SystemConfig()
+		config.motd = d["motd"]
+		config.privacy = d.get("privacy")
+		config.paidBroadcasts = d.get("paid_broadcasts")
+		return config
+	@staticmethod
+	def _userFromRow(r):
+		user = User()
+		for prop in r.keys():
+			setattr(user, prop, r[prop])
+		return user
+	def _ensure_schema(self):
+		with self.lock:
+			version = self.db.execute("PRAGMA user_version").fetchone()[0]
+			if version > len(SQLITE_MIGRATIONS):
+				raise RuntimeError("Database schema version %d is newer than supported" % version)
+			for i in range(version, len(SQLITE_MIGRATIONS)):
+				logging.debug("Migrating database schema to version %d", i + 1)
+				# each migration is applied atomically
+				self.db.execute("BEGIN")
+				SQLITE_MIGRATIONS[i](self.db)
+				self.db.execute("PRAGMA user_version = %d" % (i + 1))
+				self.db.commit()
+	def getUser(self, *, id=None, username=None):
+		if id is not None:
+			sql = "SELECT * FROM users WHERE id = ?"
+			param = id
+		elif username is not None:
+			sql = "SELECT * FROM users WHERE `username` = ? COLLATE NOCASE AND `left` IS NULL"
+			param = username
+		else:
+			raise ValueError()
+		l = self._read(sql, (param, ))
+		if len(l) == 0:
 			raise KeyError()
-		return SQLiteDatabase._userFromRow(row)
+		return self._overlay(SQLiteDatabase._userFromRow(l[0]))
 	def setUser(self, id, newuser):
-		newuser = SQLiteDatabase._userToDict(newuser)
-		del newuser['id'] # this is our primary key
-		sql = "UPDATE users SET "
-		sql += ", ".join("`%s` = ?" % k for k in newuser.keys())
-		sql += " WHERE id = ?"
-		param = list(newuser.values()) + [id, ]
-		with self.lock:
-			self.db.execute(sql, param)
+		param = [getattr(newuser, k) for k in USER_PROPS[1:]] + [id, ]
+		with self.lock:
+			self.db.execute(SQL_SET_USER, param)
+			self._written()
+	def _writeUserProps(self, changes):
+		# group by the set of changed columns so each group is one statement
+		groups = {}
+		for id, props in changes.items():
+			keys = tuple(sorted(props.keys()))
+			groups.setdefault(keys, []).append([props[k] for k in keys] + [id])
+		with self.lock:
+			for keys, params in groups.items():
+				sql = "UPDATE users SET "
+				sql += ", ".join("`%s` = ?" % k for k in keys)
+				sql += " WHERE id = ?"
+				self.db.executemany(sql, params)
+			self._written()
 	def addUser(self, newuser):
-		newuser = SQLiteDatabase._userToDict(newuser)
-		sql = "INSERT INTO users("
-		sql += ", ".join("`%s`" % k for k in newuser.keys())
-		sql += ") VALUES ("
-		sql += ", ".join("?" for i in range(len(newuser)))
-		sql += ")"
-		param = list(newuser.values())
-		with self.lock:
-			self.db.execute(sql, param)
+		param = [getattr(newuser, k) for k in USER_PROPS]
+		with self.lock:
+			self.db.execute(SQL_ADD_USER, param)
+			self._written()
+	def addUsers(self, users):
+		with self.lock:
+			# (rowcount doesn't include rows changed by triggers, unlike total_changes)
+			cur = self.db.executemany(SQL_ADD_USERS, ([getattr(u, k) for k in USER_PROPS] for u in users))
+			self.db.commit()
+			return cur.rowcount
+	def getUsers(self, ids):
+		ids = list(ids)
+		ret = {}
+		for i in range(0, len(ids), 500):
+			part = ids[i:i+500]
+			sql = "SELECT * FROM users WHERE `id` IN (" + ",".join("?" for _ in part) + ")"
+			for row in self._read(sql, part):
+				ret[row["id"]] = self._overlay(SQLiteDatabase._userFromRow(row))
+		return ret
+	def setUsers(self, users):
+		with self.lock:
+			self.db.executemany(SQL_SET_USER, ([getattr(u, k) for k in USER_PROPS[1:]] + [u.id] for u in users))
+			self._written()
+	def deleteUsers(self, ids):
+		with self.lock:
+			for id in ids:
+				self.dirty.pop(id, None)
+			cur = self.db.executemany("DELETE FROM users WHERE id = ?", ((id, ) for id in ids))
+			self._written()
+			return cur.rowcount
+	def getPrivilegedUsers(self, rank=None):
+		# "rank > 0" lets sqlite use the partial index
+		sql = "SELECT * FROM users WHERE `rank` > 0"
+		param = ()
+		if rank is not None:
+			sql += " AND `rank` = ?"
+			param = (rank, )
+		return list(self._overlay(SQLiteDatabase._userFromRow(row)) for row in self._read(sql, param))
+	def findUsers(self, term):
+		# use the full-text index created by util/blacklist.py if there is one
+		# (trigrams can't match anything shorter)
+		l = None
+		sql = "SELECT 1 FROM sqlite_master WHERE name = 'users_search'"
+		if len(term) >= 3 and len(self._read(sql)) > 0:
+			sql = "SELECT users.* FROM users_search JOIN users ON users.id = users_search.rowid"
+			sql += " WHERE users_search MATCH ? ORDER BY users_search.rank"
+			try:
+				l = self._read(sql, ['"' + term.replace('"', '""') + '"'])
+			except sqlite3.OperationalError as e:
+				pass # this SQLite lacks FTS5 or the trigram tokenizer
+		if l is None:
+			pattern = "%" + term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+			sql = "SELECT * FROM users WHERE `username` LIKE ? ESCAPE '\\' OR `realname` LIKE ? ESCAPE '\\'"
+			l = self._read(sql, (pattern, pattern))
+		if term.isdigit():
+			# ID match is ranked first
+			l = self._read("SELECT * FROM users WHERE `id` = ?", (int(term), )) + l
+		ret, seen = [], set()
+		for row in l:
+			if row["id"] not in seen:
+				seen.add(row["id"])
+				ret.append(self._overlay(SQLiteDatabase._userFromRow(row)))
+		return ret
 	def iterateUserIds(self):
 		sql = "SELECT `id` FROM users"
-		with self.lock:
-			cur = self.db.execute(sql)
-			l = cur.fetchall()
+		l = self._read(sql)
 		yield from l
+	def findBlacklisted(self, ids):
+		ids = list(ids)
+		ret = set()
+		for i in range(0, len(ids), 500):
+			part = ids[i:i+500]
+			sql = "SELECT `id` FROM users WHERE `rank` < 0 AND `id` IN (" + ",".join("?" for _ in part) + ")"
+			ret.update(row[0] for row in self._read(sql, part))
+		return ret
 	def iterateUsers(self):
 		sql = "SELECT * FROM users"
-		with self.lock:
-			cur = self.db.execute(sql)
-			l = list(SQLiteDatabase._userFromRow(row) for row in cur)
+		l = list(self._overlay(SQLiteDatabase._userFromRow(row)) for row in self._read(sql))
 		yield from l
+	def countUsers(self):
+		sql = "SELECT CASE WHEN `rank` < 0 THEN 'blacklisted' WHEN `left` IS NOT NULL THEN 'inactive'"
+		sql += " ELSE 'active' END, COUNT(*) FROM users GROUP BY 1"
+		ret = {"active": 0, "inactive": 0, "blacklisted": 0}
+		for state, n in self._read(sql):
+			ret[state] = n
+		# archived users have left long ago (see retention policy)
+		ret["inactive"] += self._read("SELECT COUNT(*) FROM users_archive")[0][0]
+		return ret
+	def removeExpiredWarnings(self, now):
+		sql = "SELECT * FROM users WHERE `left` IS NULL AND `warnExpiry` IS NOT NULL AND `warnExpiry` <= ?"
+		sql2 = "UPDATE users SET `warnings` = ?, `warnExpiry` = ? WHERE id = ?"
+		with self.lockAllUsers(), self.lock:
+			cur = self.db.execute(sql, (now, ))
+			l = list(SQLiteDatabase._userFromRow(row) for row in cur)
+			if len(l) == 0:
+				return 0
+			for user in l:
+				user.removeWarning()
+			self.db.executemany(sql2, ((u.warnings, u.warnExpiry, u.id) for u in l))
+			self.db.commit()
+		return len(l)
 	def getSystemConfig(self):
 		sql = "SELECT * FROM system_config"
-		with self.lock:
-			cur = self.db.execute(sql)
-			d = {row['name']: row['value'] for row in cur}
+		d = {row['name']: row['value'] for row in self._read(sql)}
 		return SQLiteDatabase._systemConfigFromDict(d)
 	def setSystemConfig(self, config):
 		d = SQLiteDatabase._systemConfigToDict(config)
@@ -397,3 +1236,5 @@ CREATE TABLE IF NOT EXISTS `users` (
 			for k, v in d.items():
 				if v is not None:
 					self.db.execute(sql, (k, v))
+			# rare and paid broadcast accounting relies on it surviving a crash
+			self.db.commit()
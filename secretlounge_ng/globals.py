@@ -88,6 +88,26 @@ SCORE_BASE_FORWARD = 1.25
 SCORE_TEXT_CHARACTER = 0.002
 SCORE_TEXT_LINEBREAK = 0.1
 
+# the above can be overridden by the "spam" config key (lowercase names)
+SPAM_TUNABLES = (
+	"SPAM_LIMIT", "SPAM_LIMIT_HIT", "MAX_REPLIES_PER_MINUTE", "SCORE_STICKER",
+	"SCORE_BASE_MESSAGE", "SCORE_BASE_FORWARD", "SCORE_TEXT_CHARACTER",
+	"SCORE_TEXT_LINEBREAK",
+)
+
+# returns the value of each of SPAM_TUNABLES, raises ValueError on bad config
+def spam_tunables(config):
+	ret = {k: globals()[k] for k in SPAM_TUNABLES}
+	for k, v in (config.get("spam") or {}).items():
+		k = str(k).upper()
+		if k not in ret.keys():
+			raise ValueError("unknown spam setting %r" % k.lower())
+		v = type(ret[k])(v)
+		if v < 0:
+			raise ValueError("spam setting %r can't be negative" % k.lower())
+		ret[k] = v
+	return ret
+
 # other
 MESSAGE_EXPIRE_HOURS = 30
 MOTD_REMIND_DAYS = 181
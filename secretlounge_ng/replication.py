@@ -0,0 +1,279 @@
+import logging
+import os
+import sys
+import json
+import time
+import socket
+import sqlite3
+import threading
+
+from .util import metrics
+
+# Warm standby for the SQLite backend: triggers record every change to the
+# replicated tables in `replication_log`, the primary ships these in order to
+# a standby which applies them to its own copy of the database.
+# The standby is either a local path (applied in-process) or "unix:<socket>"
+# for a standby process started with:
+#   python3 -m secretlounge_ng.replication <db path> <socket path>
+# To take over, stop the standby and start the bot on its database.
+
+# maps table -> primary key column
+REPLICATED_TABLES = {"users": "id", "users_archive": "id", "system_config": "name"}
+
+LOG_SCHEMA = """
+CREATE TABLE IF NOT EXISTS replication_log (
+	seq INTEGER PRIMARY KEY AUTOINCREMENT,
+	ts REAL NOT NULL DEFAULT ((julianday('now') - 2440587.5) * 86400.0),
+	tbl TEXT NOT NULL,
+	key NOT NULL,
+	row TEXT
+);
+"""
+
+BATCH_SIZE = 5000
+
+# module variables
+
+db = None
+target = None
+seq: int = None # last seq known to be applied by the standby
+lag = 0.0
+_conn = None # read connection used by ship()
+
+def init(config: dict, _db):
+	global db, target
+	db = _db
+	path = config["replication_target"]
+	if path.startswith("unix:"):
+		target = RemoteStandby(path[5:])
+	else:
+		target = Standby(path)
+	conn = _connect(db.path)
+	with conn:
+		setup_log(conn)
+	conn.close()
+	metrics.gauge("replication.lag", lambda: round(lag, 3))
+
+def register_tasks(sched):
+	sched.register(ship, name="replication", background=True, seconds=1)
+
+def _connect(path):
+	conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+	conn.row_factory = sqlite3.Row
+	return conn
+
+# (re)creates the triggers so they match the current table columns
+def setup_log(conn):
+	conn.executescript(LOG_SCHEMA)
+	for table, pk in REPLICATED_TABLES.items():
+		cols = list(row[1] for row in conn.execute("PRAGMA table_info(`%s`)" % table))
+		row = "json_object(" + ", ".join("'%s', NEW.`%s`" % (c, c) for c in cols) + ")"
+		for op in ("insert", "update", "delete"):
+			name = "replication_%s_%s" % (table, op)
+			conn.execute("DROP TRIGGER IF EXISTS " + name)
+			sql = "CREATE TRIGGER %s AFTER %s ON `%s` BEGIN " % (name, op.upper(), table)
+			sql += "INSERT INTO replication_log (tbl, key, row) VALUES ('%s', " % table
+			if op == "delete":
+				sql += "OLD.`%s`, NULL); END" % pk
+			else:
+				sql += "NEW.`%s`, %s); END" % (pk, row)
+			conn.execute(sql)
+
+# removes the triggers and log, otherwise changes would keep piling up in
+# the log with nothing shipping them once replication is turned off
+def remove_log(path):
+	conn = _connect(path)
+	with conn:
+		names = list(row[0] for row in conn.execute(
+			"SELECT name FROM sqlite_master WHERE type = 'trigger' AND name LIKE 'replication\\_%' ESCAPE '\\'"))
+		for name in names:
+			conn.execute("DROP TRIGGER IF EXISTS " + name)
+		conn.execute("DROP TABLE IF EXISTS replication_log")
+	conn.close()
+	if len(names) > 0:
+		logging.info("Replication is not configured, removed its triggers")
+
+# primary side
+
+def ship():
+	global seq, lag
+	conn = _reader()
+	try:
+		if seq is None:
+			seq = target.seq()
+		first = conn.execute("SELECT MIN(seq) FROM replication_log").fetchone()[0]
+		last = _last_seq(conn)
+		# standby is new, from a different primary or missing pruned changes
+		if seq < 0 or seq > last or (seq < last and (first is None or first > seq + 1)):
+			seq = _ship_snapshot(conn)
+		lag = 0.0
+		while True:
+			sql = "SELECT seq, ts, tbl, key, row FROM replication_log WHERE seq > ? ORDER BY seq LIMIT ?"
+			rows = conn.execute(sql, (seq, BATCH_SIZE)).fetchall()
+			if len(rows) == 0:
+				break
+			lag = max(lag, time.time() - rows[0]["ts"])
+			changes = list((r["seq"], r["tbl"], r["key"], r["row"]) for r in rows)
+			seq = target.apply(changes)
+			if len(rows) < BATCH_SIZE:
+				break
+	except (OSError, ValueError) as e:
+		seq = None # ask again after reconnecting
+		row = conn.execute("SELECT MIN(ts) FROM replication_log").fetchone()
+		lag = time.time() - row[0] if row[0] is not None else 0.0
+		logging.warning("Replication to standby failed: %s", e)
+		return
+	_prune(seq)
+
+def _reader():
+	global _conn
+	if _conn is None:
+		_conn = _connect(db.path)
+		_conn.isolation_level = None # autocommit, BEGIN is issued explicitly
+	return _conn
+
+# last seq ever assigned, even if the log has been pruned since
+def _last_seq(conn):
+	sql = "SELECT IFNULL((SELECT seq FROM sqlite_sequence WHERE name = 'replication_log'), 0)"
+	return conn.execute(sql).fetchone()[0]
+
+# sends a consistent copy of all tables, returns the seq it corresponds to
+def _ship_snapshot(conn):
+	conn.execute("BEGIN")
+	try:
+		s = _last_seq(conn)
+		tables = {}
+		for table in REPLICATED_TABLES.keys():
+			tables[table] = list(dict(row) for row in conn.execute("SELECT * FROM `%s`" % table))
+	finally:
+		conn.execute("COMMIT")
+	logging.info("Sending full snapshot to standby (%d users)", len(tables["users"]))
+	return target.snapshot(s, tables)
+
+# forgets changes the standby already has
+def _prune(s):
+	conn = _reader()
+	conn.execute("DELETE FROM replication_log WHERE seq <= ?", (s, ))
+
+# standby side
+
+class Standby():
+	def __init__(self, path):
+		from .database import SQLiteDatabase
+		SQLiteDatabase(path).close() # creates the schema
+		self.lock = threading.Lock()
+		self.conn = _connect(path)
+		self.conn.execute("CREATE TABLE IF NOT EXISTS replication_state (seq INTEGER NOT NULL)")
+		if self.conn.execute("SELECT 1 FROM replication_state").fetchone() is None:
+			# -1 means no data yet, the primary will send a snapshot
+			self.conn.execute("INSERT INTO replication_state (seq) VALUES (-1)")
+		self.conn.commit()
+	def seq(self):
+		with self.lock:
+			return self.conn.execute("SELECT seq FROM replication_state").fetchone()[0]
+	@staticmethod
+	def _upsert(conn, table, row):
+		keys = list(row.keys())
+		sql = "REPLACE INTO `%s` (" % table + ", ".join("`%s`" % k for k in keys) + ")"
+		sql += " VALUES (" + ", ".join("?" for _ in keys) + ")"
+		conn.execute(sql, list(row[k] for k in keys))
+	# replaces all data, `tables` maps table -> list of rows (as dicts)
+	def snapshot(self, seq, tables):
+		with self.lock, self.conn:
+			for table, rows in tables.items():
+				if table not in REPLICATED_TABLES.keys():
+					raise ValueError("unknown table %r" % table)
+				self.conn.execute("DELETE FROM `%s`" % table)
+				for row in rows:
+					Standby._upsert(self.conn, table, row)
+			self.conn.execute("UPDATE replication_state SET seq = ?", (seq, ))
+		return seq
+	# `changes` is a list of (seq, table, key, row as JSON or None if deleted)
+	def apply(self, changes):
+		with self.lock, self.conn:
+			seq = self.conn.execute("SELECT seq FROM replication_state").fetchone()[0]
+			for s, table, key, row in changes:
+				if s <= seq:
+					continue # already have it
+				pk = REPLICATED_TABLES.get(table)
+				if pk is None:
+					raise ValueError("unknown table %r" % table)
+				if row is None:
+					self.conn.execute("DELETE FROM `%s` WHERE `%s` = ?" % (table, pk), (key, ))
+				else:
+					Standby._upsert(self.conn, table, json.loads(row))
+				seq = s
+			self.conn.execute("UPDATE replication_state SET seq = ?", (seq, ))
+		return seq
+	# accepts a single primary at a time on the unix socket `path`
+	def serve(self, path):
+		if os.path.exists(path):
+			os.unlink(path)
+		sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		sock.bind(path)
+		os.chmod(path, 0o600)
+		sock.listen()
+		logging.info("Standby listening on %s", path)
+		while True:
+			conn, _ = sock.accept()
+			with conn, conn.makefile("rw", encoding="utf-8") as f:
+				try:
+					self._handle(f)
+				except (OSError, ValueError) as e:
+					logging.warning("Primary connection failed: %s", e)
+	def _handle(self, f):
+		for line in f:
+			req = json.loads(line)
+			if req["cmd"] == "seq":
+				ret = self.seq()
+			elif req["cmd"] == "snapshot":
+				ret = self.snapshot(req["seq"], req["tables"])
+				logging.info("Applied snapshot at seq %d", ret)
+			elif req["cmd"] == "apply":
+				ret = self.apply(req["changes"])
+			else:
+				raise ValueError("unknown command")
+			f.write(json.dumps({"seq": ret}) + "\n")
+			f.flush()
+
+# talks to Standby.serve() in another process
+class RemoteStandby():
+	def __init__(self, path):
+		self.path = path
+		self.f = None
+	def _call(self, cmd, **kwargs):
+		if self.f is None:
+			sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+			sock.connect(self.path)
+			self.f = sock.makefile("rw", encoding="utf-8")
+			sock.close() # the file keeps it open
+		try:
+			self.f.write(json.dumps(dict(cmd=cmd, **kwargs), default=str) + "\n")
+			self.f.flush()
+			line = self.f.readline()
+			if line == "":
+				raise OSError("connection closed by standby")
+			return json.loads(line)["seq"]
+		except Exception:
+			f, self.f = self.f, None
+			try:
+				f.close()
+			except OSError:
+				pass # flushing to a dead connection
+			raise
+	def seq(self):
+		return self._call("seq")
+	def snapshot(self, seq, tables):
+		return self._call("snapshot", seq=seq, tables=tables)
+	def apply(self, changes):
+		return self._call("apply", changes=changes)
+
+def main(argv):
+	logging.basicConfig(format="%(levelname)-7s [%(asctime)s] %(message)s", datefmt="%Y-%m-%d %H:%M:%S", level=logging.INFO)
+	if len(argv) != 2:
+		print("Usage: python3 -m secretlounge_ng.replication <db path> <socket path>")
+		exit(1)
+	Standby(argv[0]).serve(argv[1])
+
+if __name__ == "__main__":
+	main(sys.argv[1:])
@@ -3,12 +3,14 @@ import logging
 import time
 import json
 import re
+from datetime import date, datetime
+from threading import Lock, Condition, local
 from typing import Optional
 from functools import partial
 
 from . import core
 from . import replies as rp
-from .util import MutablePriorityQueue, ScoreKeeper, genTripcode
+from .util import ShardedPriorityQueue, ScoreKeeper, metrics
 from .globals import *
 
 # module constants
@@ -29,6 +31,9 @@ HIDE_FORWARD_FROM = set(s.lower() for s in [
 	"v2forwardscoverbot", "album_collector_bot", "forwards_cover_kr_bot",
 ])
 
+PAID_BROADCAST_COST = 0.1 # Stars per message
+PAID_BROADCAST_RESERVE = 100 # messages recorded as spent in the database at a time
+
 assert len(set(CAPTIONABLE_TYPES).intersection(COPYABLE_TYPES)) == 0
 
 TMessage = telebot.types.Message
@@ -38,15 +43,24 @@ TMessage = telebot.types.Message
 bot: telebot.TeleBot = None
 db = None
 ch = None
-message_queue = MutablePriorityQueue()
+message_queue = ShardedPriorityQueue() # one shard per send thread
+send_cond = Condition() # protects `sending`
+sending = 0 # messages currently in flight
+send_local = local() # `paid`: whether the item being sent by this thread is paid for
+paid_lock = Lock() # protects the three below
+paid_day = None
+paid_count = 0 # messages sent with allow_paid_broadcast on `paid_day`
+paid_reserved = 0 # how many of them are already recorded in the database
 reply_ratelimiter = ScoreKeeper(MAX_REPLIES_PER_MINUTE, 0)
 registered_commands = {}
 
 # settings
 linked_network: Optional[dict] = None
+paid_broadcast_budget: float = None
+paid_broadcast_min_queue: int = None
 
 def init(config: dict, _db, _ch):
-	global bot, db, ch, linked_network
+	global bot, db, ch, message_queue
 	if not config.get("bot_token") or ":" not in config["bot_token"]:
 		logging.error("No Telegram bot token specified")
 		exit(1)
@@ -57,12 +71,24 @@ def init(config: dict, _db, _ch):
 	bot = telebot.TeleBot(config["bot_token"], threaded=False)
 	db = _db
 	ch = _ch
+	if config.get("paid_broadcast_budget"):
+		# allows more than one message in flight, see send_thread
+		# (this also applies while nothing is paid for)
+		message_queue = ShardedPriorityQueue(int(config.get("paid_broadcast_senders", 16)))
+	if config.get("bot_api_url"):
+		setup_local_api(config["bot_api_url"], bool(config.get("bot_api_local", False)))
+	metrics.gauge("telegram.queue", lambda: len(message_queue))
+	load_paid_count()
+	metrics.gauge("telegram.paid_messages", lambda: paid_count)
+	metrics.gauge("cache.messages", lambda: len(ch.msgs))
+	metrics.gauge("cache.mappings", lambda: sum(len(d) for d in ch.idmap.values()))
 
 	allow_contacts = config["allow_contacts"]
 	allow_documents = config["allow_documents"]
-	linked_network = config.get("linked_network")
-	if linked_network is not None and not isinstance(linked_network, dict):
-		logging.error("Wrong type for 'linked_network'")
+	try:
+		set_tunables(load_tunables(config))
+	except ValueError as e:
+		logging.error("%s", e)
 		exit(1)
 	message_reaction_upvote = config.get("message_reaction_upvote", True)
 
@@ -97,6 +123,30 @@ def init(config: dict, _db, _ch):
 	if message_reaction_upvote:
 		bot.message_reaction_handler()(partial(wrap, message_reaction))
 
+# direct all API traffic to a self-hosted Bot API server at `url`,
+# `local` means it runs with --local (file paths refer to its file system)
+def setup_local_api(url, local):
+	import requests
+	url = url.rstrip("/")
+	api_url = url + "/bot{0}/{1}"
+	# the telebot settings are process-wide, even with multiple bots
+	if telebot.apihelper.API_URL not in (None, api_url):
+		logging.error("All bots in one process must use the same bot_api_url")
+		exit(1)
+	telebot.apihelper.API_URL = api_url
+	telebot.apihelper.FILE_URL = None if local else url + "/file/bot{0}/{1}"
+	# loopback: connecting is instant or the server is down, reads can still
+	# take a while since the server talks to Telegram for us
+	telebot.apihelper.CONNECT_TIMEOUT = 2
+	if telebot.apihelper.session is None:
+		# one pool shared by all threads, with a connection for each sender plus polling
+		session = requests.Session()
+		adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+			pool_maxsize=len(message_queue.shards) + 2)
+		session.mount(url + "/", adapter)
+		telebot.apihelper.session = session
+	logging.info("Using Bot API server at %s%s", url, " (local mode)" if local else "")
+
 def run():
 	assert not bot.threaded
 	while True:
@@ -110,9 +160,38 @@ def run():
 			logging.warning("%s while polling Telegram, retrying.", type(e).__name__)
 			time.sleep(1)
 
+# settings that can be changed at runtime (see __main__.reload_config),
+# this validates everything and raises an exception on error
+def load_tunables(config: dict):
+	t = {}
+	t["linked_network"] = config.get("linked_network")
+	if t["linked_network"] is not None:
+		if not isinstance(t["linked_network"], dict):
+			raise ValueError("Wrong type for 'linked_network'")
+		# lookups are case-insensitive
+		t["linked_network"] = {str(k).lower(): v for k, v in t["linked_network"].items()}
+	t["spam"] = spam_tunables(config)
+	t["paid_broadcast_budget"] = float(config.get("paid_broadcast_budget", 0))
+	t["paid_broadcast_min_queue"] = int(config.get("paid_broadcast_min_queue", 300))
+	if t["paid_broadcast_budget"] < 0 or t["paid_broadcast_min_queue"] < 0:
+		raise ValueError("paid_broadcast_* can't be negative")
+	# the send threads are set up at startup, with only one the budget
+	# would be spent without sending any faster
+	if t["paid_broadcast_budget"] and len(message_queue.shards) == 1:
+		raise ValueError("enabling paid_broadcast_budget requires a restart")
+	return t
+
+def set_tunables(t: dict):
+	global linked_network, paid_broadcast_budget, paid_broadcast_min_queue
+	linked_network = t["linked_network"]
+	paid_broadcast_budget = t["paid_broadcast_budget"]
+	paid_broadcast_min_queue = t["paid_broadcast_min_queue"]
+	globals().update(t["spam"]) # for calc_spam_score
+	reply_ratelimiter.set_limits(t["spam"]["MAX_REPLIES_PER_MINUTE"], 0)
+
 def register_tasks(sched):
 	# reply rate-limit resets fully every minute
-	sched.register((lambda: reply_ratelimiter.decrease(9999)), minutes=1)
+	sched.register((lambda: reply_ratelimiter.decrease(9999)), name="reply_ratelimit", minutes=1)
 	# cache expiration
 	def task():
 		ids = ch.expire()
@@ -128,7 +207,7 @@ def register_tasks(sched):
 		message_queue.delete(f)
 		if n > 0:
 			logging.warning("Failed to deliver %d messages before they expired from cache.", n)
-	sched.register(task, hours=6) # (1/4) * cache duration
+	sched.register(task, name="cache_expiry", jitter=60, hours=6) # (1/4) * cache duration
 
 # Wraps a telegram user in a consistent class
 class UserContainer(core.IUserContainer):
@@ -316,7 +395,7 @@ def formatter_signed_message(user: core.User, fmt: FormattedMessageBuilder):
 
 # Add tripcode message formatting for User `user` to `fmt`
 def formatter_tripcoded_message(user: core.User, fmt: FormattedMessageBuilder):
-	tripname, tripcode = genTripcode(user.tripcode)
+	tripname, tripcode = user.getTripcode()
 	# due to how prepend() works the string is built right-to-left
 	fmt.prepend("</code>:\n", True)
 	fmt.prepend(tripcode)
@@ -329,14 +408,16 @@ def formatter_tripcoded_message(user: core.User, fmt: FormattedMessageBuilder):
 # Message sending (queue-related)
 
 class QueueItem():
-	__slots__ = ("user_id", "msid", "func")
-	def __init__(self, user, msid, func):
+	__slots__ = ("user_id", "msid", "func", "payable")
+	def __init__(self, user, msid, func, payable):
 		self.user_id = None # who this item is being delivered to
 		if user is not None:
 			self.user_id = user.id
 		self.msid = msid # message id connected to this item
 		self.func = func
-	def call(self):
+		self.payable = payable # sends a message that can use allow_paid_broadcast
+	def call(self, paid=False):
+		send_local.paid = paid
 		try:
 			self.func()
 		except Exception as e:
@@ -349,13 +430,69 @@ def get_priority_for(user):
 		return max(RANKS.values()) << 16
 	return user.getMessagePriority()
 
-def put_into_queue(user, msid, f):
-	message_queue.put(get_priority_for(user), QueueItem(user, msid, f))
+def put_into_queue(user, msid, f, payable=True):
+	message_queue.put(user.id if user else 0, get_priority_for(user), QueueItem(user, msid, f, payable))
 
-def send_thread():
+# the spending is recorded in blocks of PAID_BROADCAST_RESERVE messages before
+# they're sent, so after a restart at most that much is counted too high
+def load_paid_count():
+	global paid_day, paid_count, paid_reserved
+	config = db.getSystemConfig()
+	if config is None or not config.paidBroadcasts:
+		return
+	day, n = config.paidBroadcasts.split(" ")
+	paid_day = date.fromisoformat(day)
+	paid_count = paid_reserved = int(n)
+
+def save_paid_count():
+	with db.modifySystemConfig() as config:
+		config.paidBroadcasts = "%s %d" % (paid_day.isoformat(), paid_reserved)
+
+# paid broadcasts are used while there's a big backlog and budget left for today,
+# if so this accounts for one message
+def paid_broadcast_allowed():
+	global paid_day, paid_count, paid_reserved
+	if not paid_broadcast_budget or len(message_queue) < paid_broadcast_min_queue:
+		return False
+	with paid_lock:
+		today = datetime.utcnow().date()
+		if paid_day != today:
+			if paid_count > 0:
+				logging.info("Paid broadcasts on %s: %d messages for %.1f Stars",
+					paid_day, paid_count, paid_count * PAID_BROADCAST_COST)
+			paid_day, paid_count, paid_reserved = today, 0, 0
+		if (paid_count + 1) * PAID_BROADCAST_COST > paid_broadcast_budget:
+			return False
+		if paid_count >= paid_reserved:
+			paid_reserved = paid_count + PAID_BROADCAST_RESERVE
+			save_paid_count()
+		paid_count += 1
+	return True
+
+def send_thread(shard=0):
+	global sending
 	while True:
-		item = message_queue.get()
-		item.call()
+		item = message_queue.get(shard)
+		with send_cond:
+			# the free rate limit only allows sending one at a time, more
+			# are only in flight if each of them is paid for (budget is
+			# taken here so the decision can't change until it's sent)
+			# (the threads always take turns, paid or not, so priority is only kept
+			# within a shard: a low priority message can go out before a higher one
+			# in another)
+			while True:
+				paid = (item.payable and sending < len(message_queue.shards) and
+					paid_broadcast_allowed())
+				if paid or sending == 0:
+					break
+				send_cond.wait()
+			sending += 1
+		try:
+			item.call(paid)
+		finally:
+			with send_cond:
+				sending -= 1
+				send_cond.notify_all()
 
 ###
 
@@ -395,6 +532,9 @@ def resend_message(chat_id, ev: TMessage, reply_to=None, force_caption: Optional
 		if ev.show_caption_above_media:
 			kwargs["show_caption_above_media"] = True
 
+	if getattr(send_local, "paid", False):
+		kwargs["allow_paid_broadcast"] = True
+
 	# re-send message based on content type
 	if ev.content_type == "text":
 		return bot.send_message(chat_id, ev.text, **kwargs)
@@ -414,7 +554,8 @@ def resend_message(chat_id, ev: TMessage, reply_to=None, force_caption: Optional
 	elif ev.content_type == "voice":
 		return bot.send_voice(chat_id, ev.voice.file_id, **kwargs)
 	elif ev.content_type in COPYABLE_TYPES:
-		return bot.copy_message(chat_id, ev.chat.id, ev.message_id)
+		return bot.copy_message(chat_id, ev.chat.id, ev.message_id,
+			allow_paid_broadcast=kwargs.get("allow_paid_broadcast"))
 	elif ev.content_type == "sticker":
 		return bot.send_sticker(chat_id, ev.sticker.file_id, **kwargs)
 	elif ev.content_type == "poll":
@@ -435,6 +576,8 @@ def send_to_single_inner(chat_id, ev, reply_to=None, force_caption=None):
 		elif ev.type == rp.types.KARMA_NOTIFICATION:
 			kwargs2["message_effect_id"] = "5107584321108051014" # thumbs up
 		kwargs2["parse_mode"] = "HTML"
+		if getattr(send_local, "paid", False):
+			kwargs2["allow_paid_broadcast"] = True
 		return bot.send_message(chat_id, rp.formatForTelegram(ev), **kwargs2)
 	elif isinstance(ev, FormattedMessage):
 		kwargs2 = {}
@@ -442,6 +585,8 @@ def send_to_single_inner(chat_id, ev, reply_to=None, force_caption=None):
 			kwargs2["reply_parameters"] = reply_parameters(reply_to)
 		if ev.html:
 			kwargs2["parse_mode"] = "HTML"
+		if getattr(send_local, "paid", False):
+			kwargs2["allow_paid_broadcast"] = True
 		return bot.send_message(chat_id, ev.content, **kwargs2)
 
 	return resend_message(chat_id, ev, reply_to=reply_to, force_caption=force_caption)
@@ -456,6 +601,9 @@ def send_to_single(ev, msid, user, *, reply_msid=None, force_caption=None):
 	if reply_msid is not None:
 		reply_to = ch.getMapping(user.id, reply_msid)
 
+	# forwards can't be sent as paid broadcasts
+	payable = not (isinstance(ev, TMessage) and is_forward(ev) and not should_hide_forward(ev))
+
 	user_id = user.id
 	def f():
 		while True:
@@ -468,7 +616,7 @@ def send_to_single(ev, msid, user, *, reply_msid=None, force_caption=None):
 				return
 			break
 		ch.saveMapping(user_id, msid, ev2.message_id)
-	put_into_queue(user, msid, f)
+	put_into_queue(user, msid, f, payable)
 
 # delete message with `id` in Telegram chat `user_id`
 def delete_message_inner(user_id, id):
@@ -563,7 +711,7 @@ class MyReceiver(core.Receiver):
 				def f(user_id=user_id, id=id):
 					delete_message_inner(user_id, id)
 				# msid=None here since this is a deletion, not a message being sent
-				put_into_queue(user, None, f)
+				put_into_queue(user, None, f, payable=False)
 		# drop the mappings for this message so the id doesn't end up used e.g. for replies
 		for msid in msids_set:
 			ch.deleteMappings(msid)
@@ -1,40 +1,92 @@
 import itertools
+import heapq
+import random
 import time
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from queue import PriorityQueue
-from threading import Lock
+from threading import Lock, RLock, Condition
 from datetime import timedelta
+from functools import lru_cache
 try:
 	from crypt import crypt
 except ImportError:
 	from crypt_r import crypt
 
+class ScheduledTask():
+	__slots__ = ('func', 'name', 'interval', 'jitter', 'background', 'running')
+	def __init__(self, func, name, interval, jitter, background):
+		self.func = func
+		self.name = name
+		self.interval = interval
+		self.jitter = jitter
+		self.background = background # run on the executor instead of inline
+		self.running = False
+	def next_deadline(self, now):
+		return now + self.interval + (random.uniform(0, self.jitter) if self.jitter > 0 else 0)
+
 class Scheduler():
-	def __init__(self):
-		self.tasks = [] # list of [interval, next_trigger, func]
-	@staticmethod
-	def _wrapped_call(f):
+	def __init__(self, workers=1):
+		self.heap = [] # heap of (deadline, seq, ScheduledTask)
+		self.counter = itertools.count()
+		self.cond = Condition()
+		self.workers = workers # minimum executor size
+		self.background = 0 # number of registered background tasks
+		self.executor = None
+		self.executor_size = 0
+	def _get_executor(self):
+		# one worker per background task so a slow one never delays the others,
+		# the pool can't be resized so replace it (old threads finish their work)
+		size = max(self.workers, self.background)
+		if self.executor_size < size:
+			if self.executor is not None:
+				self.executor.shutdown(wait=False)
+			self.executor = ThreadPoolExecutor(max_workers=size, thread_name_prefix="sched")
+			self.executor_size = size
+		return self.executor
+	def _call(self, task, deadline):
+		start = time.monotonic()
 		try:
-			f()
+			task.func()
 		except Exception as e:
-			logging.exception("Exception raised during scheduled task")
-	def register(self, func, **kwargs):
-		interval = timedelta(**kwargs) // timedelta(seconds=1)
+			logging.exception("Exception raised during scheduled task %s", task.name)
+		finally:
+			task.running = False
+		end = time.monotonic()
+		metrics.set("sched.%s.lateness" % task.name, round(start - deadline, 3))
+		metrics.set("sched.%s.duration" % task.name, round(end - start, 3))
+	def register(self, func, *, name=None, jitter=0, background=False, **kwargs):
+		interval = timedelta(**kwargs).total_seconds()
 		assert interval > 0
-		self.tasks.append([interval, 0, func])
+		if name is None:
+			name = getattr(func, "__qualname__", None) or repr(func)
+		task = ScheduledTask(func, name, interval, jitter, background)
+		with self.cond:
+			if background:
+				self.background += 1
+			# first run happens right away
+			heapq.heappush(self.heap, (time.monotonic(), next(self.counter), task))
+			self.cond.notify()
 	def run(self):
 		while True:
-			# Run tasks that have expired
-			now = int(time.monotonic())
-			for e in self.tasks:
-				if now >= e[1]:
-					Scheduler._wrapped_call(e[2])
-					e[1] = now + e[0]
-			# Wait until a task expires
-			now = int(time.monotonic())
-			wait = min((e[1] - now) for e in self.tasks)
-			if wait > 0:
-				time.sleep(wait)
+			with self.cond:
+				# wait until a task expires
+				while len(self.heap) == 0 or self.heap[0][0] > time.monotonic():
+					self.cond.wait(self.heap[0][0] - time.monotonic() if self.heap else None)
+				deadline, _, task = heapq.heappop(self.heap)
+			now = time.monotonic()
+			if task.running:
+				# previous invocation hasn't finished yet, skip this one
+				logging.debug("Scheduled task %s is still running, skipping", task.name)
+				metrics.add("sched.%s.skipped" % task.name)
+			elif task.background:
+				task.running = True
+				self._get_executor().submit(self._call, task, deadline)
+			else:
+				task.running = True
+				self._call(task, deadline)
+			with self.cond:
+				heapq.heappush(self.heap, (task.next_deadline(now), next(self.counter), task))
 
 class MutablePriorityQueue():
 	def __init__(self):
@@ -62,12 +114,31 @@ class MutablePriorityQueue():
 				if selector(self.items[iid]):
 					del self.items[iid]
 
+class ShardedPriorityQueue():
+	# one MutablePriorityQueue per consumer, items with the same key always
+	# end up in the same shard so their relative order is kept
+	def __init__(self, shards=1):
+		self.shards = list(MutablePriorityQueue() for _ in range(shards))
+	def __len__(self):
+		return sum(len(q.items) for q in self.shards)
+	def get(self, shard=0):
+		return self.shards[shard].get()
+	def put(self, key, prio, data):
+		self.shards[key % len(self.shards)].put(prio, data)
+	def delete(self, selector):
+		for q in self.shards:
+			q.delete(selector)
+
 class ScoreKeeper():
 	def __init__(self, limit, over_limit):
 		self.lock = Lock()
 		self.limit = limit
 		self.over_limit = max(over_limit, limit)
 		self.scores = {}
+	def set_limits(self, limit, over_limit):
+		with self.lock:
+			self.limit = limit
+			self.over_limit = max(over_limit, limit)
 	# returns false if over limit
 	def increase(self, uid, n):
 		with self.lock:
@@ -87,6 +158,123 @@ class ScoreKeeper():
 			# removes zero-ed entries
 			self.scores = {uid: (s - n) for uid, s in self.scores.items() if s > n}
 
+class TimedLock():
+	# RLock that keeps track of how long callers had to wait for it
+	def __init__(self):
+		self.lock = RLock()
+		self.acquisitions = 0
+		self.wait_total = 0.0
+		self.wait_max = 0.0
+	def acquire(self):
+		start = time.monotonic()
+		self.lock.acquire()
+		# counters are protected by the lock itself
+		waited = time.monotonic() - start
+		self.acquisitions += 1
+		self.wait_total += waited
+		self.wait_max = max(self.wait_max, waited)
+	def release(self):
+		self.lock.release()
+	def __enter__(self):
+		self.acquire()
+		return self
+	def __exit__(self, *_):
+		self.release()
+	def register_metrics(self, prefix):
+		metrics.gauge(prefix + ".acquisitions", lambda: self.acquisitions)
+		metrics.gauge(prefix + ".wait_total", lambda: round(self.wait_total, 3))
+		metrics.gauge(prefix + ".wait_max", lambda: round(self.wait_max, 3))
+
+class ExpiringMap():
+	# hashed timing wheel with `slots` buckets of `resolution` seconds each,
+	# keys are expired in O(1) as the wheel turns
+	def __init__(self, slots=256, resolution=1):
+		assert slots > 0 and resolution > 0
+		self.lock = Lock()
+		self.resolution = resolution
+		self.wheel = [set() for _ in range(slots)]
+		self.entries = {} # maps key -> (value, expiry tick)
+		self.tick = self._now()
+	def _now(self):
+		return int(time.monotonic()) // self.resolution
+	def _advance(self):
+		now = self._now()
+		if now <= self.tick:
+			return
+		# if we fell behind by more than one revolution each slot only needs a single visit
+		steps = min(now - self.tick, len(self.wheel))
+		for t in range(now - steps + 1, now + 1):
+			bucket = self.wheel[t % len(self.wheel)]
+			for key in list(bucket):
+				if self.entries[key][1] <= now:
+					bucket.discard(key)
+					del self.entries[key]
+		self.tick = now
+	def _discard(self, key):
+		e = self.entries.pop(key, None)
+		if e is not None:
+			self.wheel[e[1] % len(self.wheel)].discard(key)
+	def set(self, key, value, seconds):
+		with self.lock:
+			self._advance()
+			self._discard(key)
+			expiry = self.tick + max(-(-int(seconds) // self.resolution), 1)
+			self.entries[key] = (value, expiry)
+			self.wheel[expiry % len(self.wheel)].add(key)
+	def get(self, key, default=None):
+		with self.lock:
+			self._advance()
+			e = self.entries.get(key, None)
+			return default if e is None else e[0]
+	def pop(self, key, default=None):
+		with self.lock:
+			e = self.entries.get(key, None)
+			self._discard(key)
+			return default if e is None else e[0]
+	def __contains__(self, key):
+		with self.lock:
+			self._advance()
+			return key in self.entries
+	def __len__(self):
+		with self.lock:
+			self._advance()
+			return len(self.entries)
+	def expire(self):
+		with self.lock:
+			self._advance()
+
+class Metrics():
+	def __init__(self):
+		self.lock = Lock()
+		self.values = {} # maps name -> number
+		self.gauges = {} # maps name -> function returning number
+	def set(self, name, value):
+		with self.lock:
+			self.values[name] = value
+	def add(self, name, n=1):
+		with self.lock:
+			self.values[name] = self.values.get(name, 0) + n
+	def gauge(self, name, func):
+		with self.lock:
+			self.gauges[name] = func
+	def snapshot(self):
+		with self.lock:
+			ret = dict(self.values)
+			gauges = list(self.gauges.items())
+		for name, func in gauges:
+			try:
+				ret[name] = func()
+			except Exception as e:
+				ret[name] = None
+		return ret
+	def log(self, name=None):
+		d = self.snapshot()
+		if len(d) > 0:
+			logging.debug("Metrics%s: %s", " (%s)" % name if name else "",
+				", ".join("%s=%r" % e for e in sorted(d.items())))
+
+metrics = Metrics()
+
 # FIXME: replace this with the standard class
 class Enum():
 	def __init__(self, m, reverse=True):
@@ -128,3 +316,6 @@ def genTripcode(tripcode):
 	return trname, "!" + trip_final[-10:]
 
 assert genTripcode("#*Tp0tp8[")[1] == "!LLLLLLLLL."
+
+# for tripcodes where the result isn't stored alongside
+genTripcodeCached = lru_cache(maxsize=1024)(genTripcode)
@@ -0,0 +1,60 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+# Stand-in for a self-hosted Bot API server, implementing just the methods
+# the bot calls. Requests are recorded as (token, method, params).
+class FakeBotAPI():
+	def __init__(self):
+		self.calls = []
+		self.updates = [] # served by getUpdates
+		self.lock = threading.Lock()
+		api = self
+		class Handler(BaseHTTPRequestHandler):
+			def log_message(self, *args):
+				pass
+			def do_GET(self):
+				self._handle("")
+			def do_POST(self):
+				n = int(self.headers.get("Content-Length") or 0)
+				self._handle(self.rfile.read(n).decode())
+			def _handle(self, body):
+				# path is /bot<token>/<method>, parameters are in the query or body
+				url = urlparse(self.path)
+				parts = url.path.split("/")
+				params = {k: v[0] for k, v in parse_qs(url.query + "&" + body).items()}
+				ok, result = api.call(parts[1][3:], parts[2], params)
+				data = json.dumps({"ok": ok, "result": result} if ok else
+					{"ok": False, "error_code": 404, "description": result}).encode()
+				self.send_response(200 if ok else 404)
+				self.send_header("Content-Type", "application/json")
+				self.send_header("Content-Length", str(len(data)))
+				self.end_headers()
+				self.wfile.write(data)
+		self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+		self.url = "http://127.0.0.1:%d" % self.server.server_port
+	def start(self):
+		t = threading.Thread(target=self.server.serve_forever)
+		t.daemon = True
+		t.start()
+	def stop(self):
+		self.server.shutdown()
+		self.server.server_close()
+	def call(self, token, method, params):
+		with self.lock:
+			self.calls.append((token, method, params))
+			if method == "getMe":
+				return True, {"id": 1, "is_bot": True, "first_name": "bot", "username": "bot"}
+			elif method == "getUpdates":
+				offset = int(params.get("offset", 0))
+				return True, list(u for u in self.updates if u["update_id"] >= offset)
+			elif method == "sendMessage":
+				msg = {"message_id": 100 + len(self.calls), "date": int(time.time()),
+					"chat": {"id": int(params["chat_id"]), "type": "private"}, "text": params["text"]}
+				return True, msg
+		return False, "Not Found: method not implemented"
+	def methods(self):
+		with self.lock:
+			return list(c[1] for c in self.calls)
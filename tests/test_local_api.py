@@ -0,0 +1,76 @@
+import time
+import unittest
+
+import telebot
+
+from secretlounge_ng import core, telegram
+from secretlounge_ng.database import MemoryDatabase
+from secretlounge_ng.cache import Cache
+from secretlounge_ng.util import ShardedPriorityQueue
+
+from .fake_bot_api import FakeBotAPI
+
+CONFIG = {
+	"bot_token": "123:abc", "enable_signing": False, "allow_remove_command": False,
+	"allow_contacts": False, "allow_documents": True,
+}
+
+class LocalApiTest(unittest.TestCase):
+	def setUp(self):
+		self.api = FakeBotAPI()
+		self.api.start()
+		self.saved = {k: getattr(telebot.apihelper, k) for k in
+			("API_URL", "FILE_URL", "CONNECT_TIMEOUT", "session")}
+		telebot.apihelper.API_URL = None
+		telebot.apihelper.session = None
+		telegram.message_queue = ShardedPriorityQueue()
+	def tearDown(self):
+		if telebot.apihelper.session is not None:
+			telebot.apihelper.session.close()
+		for k, v in self.saved.items():
+			setattr(telebot.apihelper, k, v)
+		self.api.stop()
+
+	def test_setup(self):
+		telegram.setup_local_api(self.api.url + "/", False)
+		self.assertEqual(telebot.apihelper.API_URL, self.api.url + "/bot{0}/{1}")
+		self.assertEqual(telebot.apihelper.FILE_URL, self.api.url + "/file/bot{0}/{1}")
+		self.assertEqual(telebot.apihelper.CONNECT_TIMEOUT, 2)
+		# one connection per sender thread plus polling
+		adapter = telebot.apihelper.session.get_adapter(self.api.url + "/bot123:abc/getMe")
+		self.assertEqual(adapter._pool_maxsize, len(telegram.message_queue.shards) + 2)
+
+	def test_local_mode(self):
+		telegram.setup_local_api(self.api.url, True)
+		self.assertEqual(telebot.apihelper.API_URL, self.api.url + "/bot{0}/{1}")
+		self.assertIsNone(telebot.apihelper.FILE_URL)
+
+	def test_round_trip(self):
+		self.api.updates.append({"update_id": 1, "message": {
+			"message_id": 10, "date": int(time.time()), "text": "/start",
+			"chat": {"id": 42, "type": "private"},
+			"from": {"id": 42, "is_bot": False, "first_name": "Al", "username": "al"},
+			"entities": [{"type": "bot_command", "offset": 0, "length": 6}],
+		}})
+		config = dict(CONFIG, bot_api_url=self.api.url)
+		db, ch = MemoryDatabase(), Cache()
+		core.init(config, db, ch)
+		telegram.init(config, db, ch)
+
+		updates = telegram.bot.get_updates(offset=0, timeout=0)
+		self.assertEqual(len(updates), 1)
+		telegram.bot.process_new_updates(updates)
+		self.assertTrue(db.getUser(id=42).isJoined())
+
+		# the welcome reply is queued, send it like a send thread would
+		self.assertEqual(len(telegram.message_queue), 1)
+		telegram.message_queue.get().call()
+		sent = list(c for c in self.api.calls if c[1] == "sendMessage")
+		self.assertEqual(len(sent), 1)
+		token, _, params = sent[0]
+		self.assertEqual(token, "123:abc")
+		self.assertEqual(params["chat_id"], "42")
+		self.assertEqual(self.api.methods().count("getUpdates"), 1)
+
+if __name__ == "__main__":
+	unittest.main()
@@ -3,8 +3,10 @@ import sys
 import os
 import logging
 import sqlite3
+import socket
+import json
 import readline # for input()
-from datetime import datetime, timedelta
+from datetime import datetime
 from time import sleep
 
 # database
@@ -15,16 +17,27 @@ class Database():
 		t = sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES
 		self.db = sqlite3.connect(path, detect_types=t)
 		self.db.row_factory = sqlite3.Row
+		# if the bot is running with an admin socket, changes go through it
+		self.admin = None
+		sockpath = os.path.join(os.path.dirname(path), "admin.sock")
+		if os.path.exists(sockpath):
+			try:
+				self.admin = AdminClient(sockpath)
+			except OSError as e:
+				# stale socket, the bot isn't running (anymore)
+				logging.warning("Not using admin socket %s: %s", sockpath, e)
 	def modify_custom(self, func):
 		while True:
 			try:
-				func()
+				ret = func()
 			except sqlite3.OperationalError as e:
 				if "database is locked" in str(e):
+					self.db.rollback() # throw away partial work of `func`
 					continue # just retry, sqlite will do the waiting for us
 				raise
 			break
 		self.db.commit()
+		return ret
 	def modify(self, sql, args=()):
 		self.modify_custom(lambda: self.db.execute(sql, args))
 	# wrappers for standard functions
@@ -45,6 +58,38 @@ class Database():
 	def commit(self):
 		return self.db.commit()
 
+# talks to the running bot (see secretlounge_ng/admin.py)
+class AdminClient():
+	def __init__(self, path):
+		self.path = path
+		# make sure something is listening
+		with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+			sock.connect(self.path)
+	def call(self, cmd, **kwargs):
+		with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+			sock.connect(self.path)
+			with sock.makefile("rw", encoding="utf-8") as f:
+				f.write(json.dumps(dict(cmd=cmd, **kwargs)) + "\n")
+				f.flush()
+				resp = json.loads(f.readline())
+		if not resp["ok"]:
+			raise Exception("Admin socket: " + resp["error"])
+		return resp["result"]
+	# returns user rows in the same format as find_user
+	def call_users(self, cmd, **kwargs):
+		ret = {}
+		for row in self.call(cmd, **kwargs):
+			ret[row[0]] = tuple(self._convert(v) for v in row[1:])
+		return ret
+	@staticmethod
+	def _convert(v):
+		if isinstance(v, str) and len(v) >= 19 and v[4] == "-" and v[10] == " ":
+			try:
+				return datetime.fromisoformat(v)
+			except ValueError:
+				pass
+		return v
+
 def detect_db_paths():
 	single_path = os.environ.get("DATABASE_PATH", "./db.sqlite")
 	if single_path and os.path.isfile(single_path): # no fancy structure...
@@ -84,78 +129,239 @@ def print_function_help(table):
 
 # backend
 
+# applies bans given as list of (id, reason) in a single transaction
+def ban_users(db, entries):
+	if db.admin:
+		return tuple(db.admin.call("ban", entries=entries))
+	nodate = datetime.utcfromtimestamp(0)
+	def f():
+		known = {}
+		ids = list(e[0] for e in entries)
+		for i in range(0, len(ids), 500):
+			part = ids[i:i+500]
+			sql = "SELECT id, rank FROM users WHERE id IN (" + ",".join("?" for _ in part) + ")"
+			for row in db.db.execute(sql, part):
+				known[row[0]] = row[1]
+		new, update = {}, {}
+		for id, reason in entries:
+			if id not in known.keys():
+				# user was never here, add an placeholder entry to still ban them
+				new[id] = (id, "", -10, nodate, nodate, nodate, reason, 0, 0, 0, 0)
+			elif known[id] != -10:
+				update[id] = (-10, datetime.now(), reason, id)
+		sql = "INSERT INTO users (id, realname, rank, joined, left, lastActive, blacklistReason,"
+		sql += " warnings, karma, hideKarma, debugEnabled) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+		db.db.executemany(sql, new.values())
+		sql = "UPDATE users SET rank = ?, left = ?, blacklistReason = ? WHERE id = ?"
+		db.db.executemany(sql, update.values())
+		return len(update), len(new)
+	return db.modify_custom(f)
+
 def ban_user(db, id, reason):
-	c = db.execute("SELECT rank FROM users WHERE id = ?", (id, ))
-	row = c.fetchone()
-	if row is None:
-		# user was never here, add an placeholder entry to still ban them
-		nodate = datetime.utcfromtimestamp(0)
-		u = {
-			"id": id,
-			"realname": "",
-			"rank": -10,
-			"joined": nodate,
-			"left": nodate,
-			"lastActive": nodate,
-			"blacklistReason": reason,
-			"warnings": 0,
-			"karma": 0,
-			"hideKarma": 0,
-			"debugEnabled": 0,
-		}
-		sql = "INSERT INTO users (" + ( ", ".join(u.keys()) ) + ") VALUES (" + ( ", ".join("?" for _ in u) ) + ")"
-		db.modify(sql, tuple(u.values()))
-		return 0, 1
-	elif row[0] == -10:
-		return 0, 0 # user was already banned
-	# update user values to ban them
-	param = (-10, datetime.now(), reason, id)
-	db.modify("UPDATE users SET rank = ?, left = ?, blacklistReason = ? WHERE id = ?", param)
-	return 1, 0
+	return ban_users(db, [(id, reason)])
+
+# lifts bans for a list of ids in a single transaction
+def unban_users(db, ids):
+	if db.admin:
+		return db.admin.call("unban", ids=ids)
+	nodate = datetime.utcfromtimestamp(0)
+	def f():
+		# placeholder entries are just deleted instead
+		# (rowcount doesn't include rows changed by triggers, unlike total_changes)
+		sql = "DELETE FROM users WHERE id = ? AND rank = -10 AND left = ?"
+		n = db.db.executemany(sql, ((id, nodate) for id in ids)).rowcount
+		sql = "UPDATE users SET rank = 0, blacklistReason = NULL WHERE id = ? AND rank = -10"
+		n += db.db.executemany(sql, ((id, ) for id in ids)).rowcount
+		return n
+	return db.modify_custom(f)
 
 def unban_user(db, id):
-	c = db.execute("SELECT left FROM users WHERE id = ? AND rank = ?", (id, -10))
-	row = c.fetchone()
-	if row is None:
-		return 0
-	if row[0] == datetime.utcfromtimestamp(0):
-		# this is a placeholder entry, just delete it instead
-		db.modify("DELETE FROM users WHERE id = ?", (id, ))
-	else:
-		db.modify("UPDATE users SET rank = ?, blacklistReason = NULL WHERE id = ?", (0, id))
-	return 1
+	return unban_users(db, [id])
+
+# reads "<user id> [reason]" lines from a file ("-" for stdin) in batches
+def read_id_file(path, batch_size=10000):
+	f = sys.stdin if path == "-" else open(path, "r")
+	batch = []
+	with f:
+		for n, line in enumerate(f, 1):
+			line = line.strip()
+			if line == "" or line.startswith("#"):
+				continue
+			id, _, reason = line.partition(" ")
+			try:
+				batch.append((int(id), reason.strip()))
+			except ValueError:
+				logging.warning("Ignoring invalid line %d", n)
+				continue
+			if len(batch) >= batch_size:
+				yield batch
+				batch = []
+	if len(batch) > 0:
+		yield batch
+
+# bans are recorded into a table by triggers, which the sync consumes
+BAN_EVENTS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS ban_events (
+	seq INTEGER PRIMARY KEY AUTOINCREMENT,
+	id BIGINT NOT NULL,
+	reason TEXT
+);
+CREATE TABLE IF NOT EXISTS ban_events_cursor (
+	name TEXT NOT NULL,
+	seq INTEGER NOT NULL,
+	PRIMARY KEY (name)
+);
+CREATE TRIGGER IF NOT EXISTS ban_events_update AFTER UPDATE OF rank ON users
+	WHEN NEW.rank = -10 AND OLD.rank != -10
+BEGIN
+	INSERT INTO ban_events (id, reason) VALUES (NEW.id, NEW.blacklistReason);
+END;
+CREATE TRIGGER IF NOT EXISTS ban_events_insert AFTER INSERT ON users
+	WHEN NEW.rank = -10
+BEGIN
+	INSERT INTO ban_events (id, reason) VALUES (NEW.id, NEW.blacklistReason);
+END;
+"""
+
+def setup_ban_events(db):
+	db.modify_custom(lambda: db.db.executescript(BAN_EVENTS_SCHEMA))
+
+# returns None if there is no cursor yet
+def get_ban_cursor(db):
+	row = db.execute("SELECT seq FROM ban_events_cursor WHERE name = 'sync'").fetchone()
+	return None if row is None else row[0]
+
+def set_ban_cursor(db, seq):
+	def f():
+		db.db.execute("REPLACE INTO ban_events_cursor (name, seq) VALUES ('sync', ?)", (seq, ))
+		db.db.execute("DELETE FROM ban_events WHERE seq <= ?", (seq, ))
+	db.modify_custom(f)
 
 def sync(d):
-	interval = 60
-	last_update = datetime.utcfromtimestamp(0.0)
+	interval = 5
+	for db in d.values():
+		setup_ban_events(db)
+	cursors = {name: get_ban_cursor(db) for name, db in d.items()}
+	stored = dict(cursors)
 	logging.info("Running periodic blacklist sync (every %ds)", interval)
 	while True:
-		now = datetime.now() - timedelta(seconds=5)
 		# find all blacklists that happened since our last update
-		l = []
+		l = {} # maps source name -> list of (id, reason)
 		for name, db in d.items():
-			c = db.execute("SELECT id, blacklistReason FROM users WHERE rank = ? AND left >= ?", (-10, last_update))
+			row = db.execute("SELECT MAX(seq) FROM ban_events").fetchone()
+			seq = row[0] or 0
+			if cursors[name] is None:
+				# first run: consider all existing bans
+				c = db.execute("SELECT id, blacklistReason FROM users WHERE rank = -10")
+			elif seq > cursors[name]:
+				c = db.execute("SELECT id, reason FROM ban_events WHERE seq > ? AND seq <= ? ORDER BY seq", (cursors[name], seq))
+			else:
+				continue
 			for row in c:
 				reason = row[1] or ""
 				if reason.endswith("]"): # transferred from elsewhere?
 					continue
-				l.append((row[0], reason, name))
-		# apply the same bans on other instances
-		for id, reason, from_name in l:
-			reason = reason + " [" + from_name + "]"
-			stat1, stat2 = 0, 0
-			for db in d.values():
-				a, b = ban_user(db, id, reason)
-				stat1 += a; stat2 += b
+				l.setdefault(name, []).append((row[0], reason + " [" + name + "]"))
+			cursors[name] = seq
+		# apply the same bans on other instances, one transaction per database
+		for target_name, db in d.items():
+			entries = []
+			for from_name, e in l.items():
+				if from_name != target_name:
+					entries.extend(e)
+			if len(entries) == 0:
+				continue
+			stat1, stat2 = ban_users(db, entries)
 			if stat1 + stat2 > 0:
-				logging.info("Transferred ban of user id %d orginated from %s (b:%d p:%d)", id, from_name, stat1, stat2)
+				logging.info("Transferred %d ban(s) to %s (b:%d p:%d)", stat1 + stat2, target_name, stat1, stat2)
+		# only now mark the events as consumed
+		for name, db in d.items():
+			if stored[name] != cursors[name]:
+				set_ban_cursor(db, cursors[name])
+				stored[name] = cursors[name]
 		# Zzz..
-		last_update = now
 		sleep(interval)
 
-def find_user(db, term):
+# full-text index over names, kept in sync by triggers
+# (the trigram tokenizer allows substring matches like LIKE '%term%')
+USER_SEARCH_SCHEMA = """
+CREATE VIRTUAL TABLE users_search USING fts5(username, realname, tokenize='trigram');
+CREATE TRIGGER users_search_insert AFTER INSERT ON users
+BEGIN
+	INSERT INTO users_search (rowid, username, realname) VALUES (NEW.id, NEW.username, NEW.realname);
+END;
+CREATE TRIGGER users_search_update AFTER UPDATE OF username, realname ON users
+	WHEN OLD.username IS NOT NEW.username OR OLD.realname IS NOT NEW.realname
+BEGIN
+	DELETE FROM users_search WHERE rowid = OLD.id;
+	INSERT INTO users_search (rowid, username, realname) VALUES (NEW.id, NEW.username, NEW.realname);
+END;
+CREATE TRIGGER users_search_delete AFTER DELETE ON users
+BEGIN
+	DELETE FROM users_search WHERE rowid = OLD.id;
+END;
+"""
+
+# existing users are indexed in short transactions so a running bot
+# isn't locked out of the database while this happens
+USER_SEARCH_BATCH = 2000
+
+def _fill_user_search(db):
+	last = 0
+	while True:
+		c = db.execute("SELECT id FROM users WHERE id > ? ORDER BY id LIMIT 1 OFFSET ?",
+			(last, USER_SEARCH_BATCH - 1))
+		row = c.fetchone()
+		end = row[0] if row is not None else None
+		sql = "INSERT INTO users_search (rowid, username, realname)"
+		sql += " SELECT id, username, realname FROM users WHERE id > ?"
+		args = [last]
+		if end is not None:
+			sql += " AND id <= ?"
+			args.append(end)
+		# rows added or renamed since the triggers exist are already indexed
+		sql += " AND NOT EXISTS (SELECT 1 FROM users_search WHERE rowid = users.id)"
+		db.modify(sql, args)
+		if end is None:
+			break
+		last = end
+
+# returns whether the full-text index can be used
+def setup_user_search(db):
+	c = db.execute("SELECT 1 FROM sqlite_master WHERE name = 'users_search'")
+	if c.fetchone() is None:
+		try:
+			db.modify_custom(lambda: db.db.executescript("BEGIN;" + USER_SEARCH_SCHEMA + "COMMIT;"))
+		except sqlite3.OperationalError as e:
+			# no FTS5 or trigram tokenizer (SQLite < 3.34)
+			db.db.rollback()
+			logging.warning("Full-text search not available, falling back to slow search (%s)", e)
+			return False
+		logging.info("Building full-text index...")
+	# also completes an index whose build was interrupted
+	_fill_user_search(db)
+	return True
+
+def find_user(db, term, fts=False):
 	attrs = ("username", "realname", "rank", "joined", "left", "lastActive",
 		 "cooldownUntil", "blacklistReason", "warnings", "warnExpiry", "karma")
+	if db.admin:
+		return db.admin.call_users("find", term=term), attrs
+	if fts and len(term) >= 3: # trigrams can't match anything shorter
+		cols = "users.id, " + ",".join("users." + s for s in attrs)
+		sql = "SELECT " + cols + ", users_search.rank FROM users_search"
+		sql += " JOIN users ON users.id = users_search.rowid WHERE users_search MATCH ?"
+		args = ['"' + term.replace('"', '""') + '"']
+		# numeric argument also searches for ID match (ranked first)
+		if term.isdigit():
+			sql = "SELECT " + cols + ", -1e300 FROM users WHERE id = ? UNION ALL " + sql
+			args = [int(term)] + args
+		sql += " ORDER BY %d" % (len(attrs) + 2)
+		c = db.execute(sql, args)
+		ret = {}
+		for row in c:
+			ret.setdefault(row[0], tuple(row)[1:-1])
+		return ret, attrs
 	sql = "SELECT id, " + ",".join(attrs) + " FROM users WHERE"
 	sql += " username LIKE ? OR realname LIKE ?"
 	args = ["%" + term + "%", "%" + term + "%"]
@@ -195,6 +401,38 @@ def c_unban(d, argv):
 		return logging.warning("This user wasn't blacklisted anywhere.")
 	logging.info("Success (unbanned:%d)", stat)
 
+def c_bulkban(d, argv):
+	"""bulkban <file> [reason]
+		Blacklist all users listed in file (- for stdin)
+		Each line contains a user id, optionally followed by a reason
+		that overrides the one given on the command line"""
+	if len(argv) < 1:
+		return Exception
+	default_reason = " ".join(argv[1:])
+	total, stat1, stat2 = 0, 0, 0
+	for batch in read_id_file(argv[0]):
+		batch = list((id, reason or default_reason) for id, reason in batch)
+		for db in d.values():
+			a, b = ban_users(db, batch)
+			stat1 += a; stat2 += b
+		total += len(batch)
+		logging.info("Processed %d ids", total)
+	logging.info("Success (ids:%d banned:%d placeholder:%d)", total, stat1, stat2)
+
+def c_bulkunban(d, argv):
+	"""bulkunban <file>
+		Unban all users listed in file (- for stdin)"""
+	if len(argv) != 1:
+		return Exception
+	total, stat = 0, 0
+	for batch in read_id_file(argv[0]):
+		ids = list(e[0] for e in batch)
+		for db in d.values():
+			stat += unban_users(db, ids)
+		total += len(batch)
+		logging.info("Processed %d ids", total)
+	logging.info("Success (ids:%d unbanned:%d)", total, stat)
+
 def c_find(d, argv):
 	"""find\nInteractive prompt that searches users"""
 	if len(argv) != 0:
@@ -207,6 +445,7 @@ def c_find(d, argv):
 		elif isinstance(x, str):
 			return "\u202a" + x + "\u202c" # embed RTL text correctly
 		return str(x)
+	fts = {name: setup_user_search(db) for name, db in d.items()}
 	if sys.platform == 'linux':
 		prompt_str = "\033[35mfind>\033[0m "
 	else:
@@ -221,7 +460,7 @@ def c_find(d, argv):
 
 		any_ = False
 		for dbname in sorted(d.keys()):
-			ret, attrs = find_user(d[dbname], p)
+			ret, attrs = find_user(d[dbname], p, fts[dbname])
 			if len(ret) == 0:
 				continue
 			any_ = True
@@ -260,7 +499,8 @@ def main(argv):
 	logging.basicConfig(format="[%(asctime)s] %(message)s", datefmt="%Y-%m-%d %H:%M", level=logging.INFO)
 
 	actions = {
-		"ban": c_ban, "unban": c_unban, "find": c_find, "sync": c_sync
+		"ban": c_ban, "unban": c_unban, "bulkban": c_bulkban,
+		"bulkunban": c_bulkunban, "find": c_find, "sync": c_sync
 	}
 
 	if len(argv) > 0:
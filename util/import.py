@@ -11,14 +11,109 @@ from secretlounge_ng.globals import *
 from secretlounge_ng.database import User, SystemConfig, JSONDatabase, SQLiteDatabase
 from secretlounge_ng.__main__ import open_db, load_config
 
+BATCH_SIZE = 5000
+
 def safe_time(n):
 	if n > 2**32:
 		n = 2**32
 	return datetime.utcfromtimestamp(n)
 
+# Incremental parser for the legacy export, which is a JSON object of the form
+# {"users": [...], "system": {...}}. Yields ("users", <element>) for every user
+# and (<key>, <value>) for all other keys, without loading the whole file.
+class StreamingParser():
+	def __init__(self, f, chunk_size=1 << 16):
+		self.f = f
+		self.chunk_size = chunk_size
+		self.buf = ""
+		self.pos = 0
+		self.eof = False
+		self.decoder = json.JSONDecoder()
+	def _fill(self):
+		if self.eof:
+			return False
+		data = self.f.read(self.chunk_size)
+		if not data:
+			self.eof = True
+			return False
+		self.buf = self.buf[self.pos:] + data
+		self.pos = 0
+		return True
+	def _peek(self):
+		while True:
+			while self.pos < len(self.buf) and self.buf[self.pos] in " \t\r\n":
+				self.pos += 1
+			if self.pos < len(self.buf):
+				return self.buf[self.pos]
+			if not self._fill():
+				raise ValueError("unexpected end of file")
+	def _expect(self, c):
+		if self._peek() != c:
+			raise ValueError("expected %r at offset %d" % (c, self.pos))
+		self.pos += 1
+	def _value(self):
+		self._peek()
+		while True:
+			try:
+				value, end = self.decoder.raw_decode(self.buf, self.pos)
+			except json.JSONDecodeError:
+				# value might continue in the next chunk
+				if self._fill():
+					continue
+				raise
+			# numbers might continue in the next chunk as well
+			if end == len(self.buf) and self._fill():
+				continue
+			self.pos = end
+			return value
+	def __iter__(self):
+		self._expect("{")
+		if self._peek() == "}":
+			return
+		while True:
+			key = self._value()
+			self._expect(":")
+			if key == "users":
+				self._expect("[")
+				if self._peek() != "]":
+					while True:
+						yield "users", self._value()
+						if self._peek() == "]":
+							break
+						self._expect(",")
+				self._expect("]")
+			else:
+				yield key, self._value()
+			if self._peek() == "}":
+				break
+			self._expect(",")
+
+def convert_user(j):
+	u = User()
+	u.id = j["id"]
+	u.username = j.get("username", None)
+	u.realname = j.get("realname", "")
+	u.rank = j["rank"]
+	u.joined = safe_time(0)
+	if j.get("left", False) != False:
+		u.left = safe_time(j["left"] // 1000)
+	u.lastActive = u.joined
+	if "banned" in j.keys():
+		u.cooldownUntil = safe_time(j["banned"] // 1000)
+	if "reason" in j.keys():
+		u.blacklistReason = j["reason"]
+	u.warnings = j.get("warnings", 0)
+	if u.warnings > 0:
+		u.warnExpiry = safe_time(j["warnUpdated"] // 1000) + timedelta(hours=WARN_EXPIRE_HOURS)
+	u.karma = j.get("karma", 0)
+	u.hideKarma = j.get("hideKarma", False)
+	u.debugEnabled = j.get("debug", False)
+	return u
+
 def usage():
 	print("Import database from legacy secretlounge instances")
 	print("Usage: import.py <config file> <original db>")
+	print("An interrupted import can be resumed by running the same command again.")
 
 def main(configpath, importpath):
 	config = load_config(configpath)
@@ -27,43 +122,54 @@ def main(configpath, importpath):
 
 	db = open_db(config)
 
+	# number of users already imported by a previous run
+	checkpoint = importpath + ".checkpoint"
+	skip = 0
+	if os.path.exists(checkpoint):
+		with open(checkpoint, "r") as f:
+			skip = int(f.read().strip() or 0)
+		logging.info("Resuming import after %d users", skip)
+
+	def save_checkpoint(n):
+		with open(checkpoint + "~", "w") as f:
+			f.write(str(n))
+		os.replace(checkpoint + "~", checkpoint)
+
+	batch = []
+	n, added = 0, 0
+	system = None
+	def flush():
+		nonlocal batch, added
+		k = db.addUsers(batch)
+		if k < len(batch):
+			logging.warning("%d duplicate users were dropped", len(batch) - k)
+		added += k
+		batch = []
+		save_checkpoint(n)
+		logging.info("Imported %d users", n)
+
 	with open(importpath, "r") as f:
-		data = json.load(f)
-
-	had_ids = set()
-	for j in data["users"]:
-		u = User()
-		u.id = j["id"]
-		u.username = j.get("username", None)
-		u.realname = j.get("realname", "")
-		u.rank = j["rank"]
-		u.joined = safe_time(0)
-		if j.get("left", False) != False:
-			u.left = safe_time(j["left"] // 1000)
-		u.lastActive = u.joined
-		if "banned" in j.keys():
-			u.cooldownUntil = safe_time(j["banned"] // 1000)
-		if "reason" in j.keys():
-			u.blacklistReason = j["reason"]
-		u.warnings = j.get("warnings", 0)
-		if u.warnings > 0:
-			u.warnExpiry = safe_time(j["warnUpdated"] // 1000) + timedelta(hours=WARN_EXPIRE_HOURS)
-		u.karma = j.get("karma", 0)
-		u.hideKarma = j.get("hideKarma", False)
-		u.debugEnabled = j.get("debug", False)
-
-		if u.id in had_ids:
-			logging.warning("%s is duplicate, dropping the second one", u)
-		else:
-			db.addUser(u)
-			had_ids.add(u.id)
+		for key, value in StreamingParser(f):
+			if key == "system":
+				system = value
+				continue
+			elif key != "users":
+				continue
+			n += 1
+			if n <= skip:
+				continue
+			batch.append(convert_user(value))
+			if len(batch) >= BATCH_SIZE:
+				flush()
+	flush()
 
 	c = SystemConfig()
-	c.motd = data["system"]["motd"]
+	c.motd = system["motd"]
 	db.setSystemConfig(c)
 
-	logging.info("Success.")
+	logging.info("Success (%d users, %d added).", n, added)
 	db.close()
+	os.remove(checkpoint)
 
 if __name__ == "__main__":
 	if len(sys.argv) < 3:
@@ -6,17 +6,27 @@ from blacklist import detect_dbs, print_function_help
 
 # backend
 
-def list_privileged_users(db, cond="rank > 0"):
-	sql = "SELECT id, username, realname, rank, left, lastActive FROM users WHERE " + cond
-	c = db.execute(sql)
+def list_privileged_users(db, rank=None):
+	if db.admin:
+		# same columns as below, from the rows returned by the bot
+		rows = ((id, e[0], e[1], e[2], e[4], e[5]) for id, e in
+			db.admin.call_users("list", rank=rank).items())
+	else:
+		# "rank > 0" lets sqlite use the partial index
+		sql = "SELECT id, username, realname, rank, left, lastActive FROM users WHERE rank > 0"
+		if rank is not None:
+			sql += " AND rank = %d" % rank
+		rows = db.execute(sql)
 	ret = {}
-	for row in c:
+	for row in rows:
 		user = ("@" + row[1]) if row[1] is not None else row[2]
 		active = None if row[4] is not None else row[5]
 		ret[row[0]] = (user, row[3], active)
 	return ret
 
 def set_user_rank(db, id, rank):
+	if db.admin:
+		return db.admin.call("setrank", id=id, rank=rank)
 	c = db.execute("SELECT 1 FROM users WHERE id = ?", (id, ))
 	if c.fetchone() is None:
 		return False
@@ -42,10 +52,10 @@ def c_list(d, argv):
 
 	db = d[argv[0]]
 	if len(argv) > 1:
-		cond = ({"-a": "rank = 100", "-m": "rank = 10"}).get(argv[1])
-		if not cond:
+		rank = ({"-a": 100, "-m": 10}).get(argv[1])
+		if not rank:
 			return Exception
-		t = list_privileged_users(db, cond)
+		t = list_privileged_users(db, rank)
 	else:
 		t = list_privileged_users(db)
 	if len(t) == 0: